@@ -5,36 +5,206 @@ Created on Mon Apr  3 19:58:56 2023
 @author: ian.michael.bollinger@gmail.com
 """
 ### FASTA FUNCTIONS
-from Bio import SeqIO
-import pandas as pd
-from io import StringIO
-from Bio.SeqRecord import SeqRecord
-from Bio.Seq import Seq
+import os
+import mmap
+import hashlib
+import numpy as np
+
+# Constants
+FILE_CHUNK_SIZE = 1 << 20
+FASTA_LINE_WIDTH = 60
+
+# MD5 checksums keyed by (absolute path, mtime, size), so an unchanged file is only ever hashed once
+md5_cache = {}
+
+def file_signature(file_path: str) -> tuple:
+    # Identify a file version by its path, modification time and size
+    file_stat = os.stat(file_path)
+    return (os.path.abspath(file_path), file_stat.st_mtime_ns, file_stat.st_size)
+
+def cache_md5_checksum(file_path: str, md5: str):
+    # Store a checksum computed elsewhere, e.g. while the file was being parsed
+    md5_cache[file_signature(file_path)] = md5
+
+def md5_checksum(file_path: str, chunk_size: int = FILE_CHUNK_SIZE) -> str:
+    # Hash the file in fixed-size chunks, reusing the cached checksum if the file has not changed
+    signature = file_signature(file_path)
+    if signature not in md5_cache:
+        file_hash = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                file_hash.update(chunk)
+        md5_cache[signature] = file_hash.hexdigest()
+    
+    return md5_cache[signature]
 
 def fasta_to_dataframe(fasta_file: str):
-    # Parse the FASTA file and store the records in a list of dictionaries
-    records = SeqIO.parse(fasta_file, 'fasta')
-    data = [{'ID': record.id, 'Description': record.description, 'Sequence': str(record.seq)} for record in records]
+    # Parse the FASTA file with the memory-mapped parser and store the records in a DataFrame
+    # pandas is imported here so the streaming paths never pay for it
+    import pandas as pd
+    data = [{'ID': record_id, 'Description': description, 'Sequence': str(sequence, 'latin-1')}
+            for record_id, description, sequence in mmap_fasta_records(fasta_file)]
     
     # Convert the list of dictionaries into a DataFrame
-    df = pd.DataFrame(data)
+    df = pd.DataFrame(data, columns=['ID', 'Description', 'Sequence'])
     return df
 
-def reconstruct_fna_from_df(df, output_file_path: str):
-    # Generate an .fna file-type from a given dataframe
-    with open(output_file_path, 'w') as f:
-        for index, row in df.iterrows():
-            description = row['Description']
-            sequence = row['Sequence']
+def fasta_record_id(description: str) -> str:
+    # Record ID as SeqIO reads it: the first whitespace-delimited word of the header line
+    return (description.split(None, 1) or [''])[0]
+
+def mmap_fasta_records(fasta_file: str, file_hash=None):
+    # Yield (ID, Description, Sequence) records from a memory map of the file, finding headers with bytes.find
+    # Single-line sequences are memoryviews into the map; wrapped ones are one bytes copy with the newlines translated out
+    # The mapped bytes also feed file_hash (e.g. hashlib.md5()) when one is given
+    with open(fasta_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        fasta_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    fasta_view = memoryview(fasta_map)
+    file_size = len(fasta_map)
+    hashed_bytes = 0
+    try:
+        # Records start with '>' at the start of a line; anything before the first header is skipped
+        header_start = 0 if fasta_map[:1] == b'>' else fasta_map.find(b'\n>') + 1 or -1
+        while header_start >= 0:
+            header_end = fasta_map.find(b'\n', header_start)
+            header_end = file_size if header_end < 0 else header_end
+            next_header = fasta_map.find(b'\n>', header_end)
+            sequence_start = min(header_end + 1, file_size)
+            sequence_end = file_size if next_header < 0 else next_header
             
-            # Remove trailing spaces from sequence
-            sequence = sequence.rstrip()
+            # Trailing line breaks belong to no base; any left inside the span are translated out
+            while sequence_end > sequence_start and fasta_map[sequence_end - 1] in b'\r\n':
+                sequence_end -= 1
+            if fasta_map.find(b'\n', sequence_start, sequence_end) >= 0 or fasta_map.find(b'\r', sequence_start, sequence_end) >= 0:
+                sequence = fasta_map[sequence_start:sequence_end].translate(None, b'\r\n')
+            else:
+                sequence = fasta_view[sequence_start:sequence_end]
             
-            # Write record to buffer
-            buffer = StringIO()
-            SeqIO.write([SeqRecord(Seq(sequence), id=str(index), description=description)], buffer, 'fasta')
-            buffer.seek(0)
+            if file_hash is not None:
+                record_end = file_size if next_header < 0 else next_header
+                file_hash.update(fasta_view[hashed_bytes:record_end])
+                hashed_bytes = record_end
+            description = fasta_map[header_start + 1:header_end].rstrip().decode('latin-1')
+            yield (fasta_record_id(description), description, sequence)
+            header_start = -1 if next_header < 0 else next_header + 1
+        
+        if file_hash is not None:
+            file_hash.update(fasta_view[hashed_bytes:])
+    finally:
+        # Sequence views still held by the caller keep the map open until they are released
+        fasta_view.release()
+        try:
+            fasta_map.close()
+        except BufferError:
+            pass
+
+def iter_fasta_records(fasta_file: str, buffer_size: int = FILE_CHUNK_SIZE, file_hash=None):
+    # Stream (ID, Description, Sequence) records one at a time; the sequence is kept as bytes
+    # The file is read in chunks, and every chunk also feeds file_hash (e.g. hashlib.md5()) when one is given
+    description = None
+    sequence = bytearray()
+    line_buffer = bytearray()
+    with open(fasta_file, 'rb') as f:
+        while True:
+            chunk = f.read(buffer_size)
+            if file_hash is not None:
+                file_hash.update(chunk)
             
-            # Parse record from buffer and write to output file
-            for record in SeqIO.parse(buffer, 'fasta'):
-                f.write(record.format('fasta'))
\ No newline at end of file
+            # Only the new chunk is searched, so long unwrapped sequence lines are buffered in linear time
+            last_newline = chunk.rfind(b'\n')
+            if chunk and last_newline < 0:
+                line_buffer += chunk
+                continue
+            line_buffer += chunk[:last_newline] if chunk else b''
+            lines = line_buffer.split(b'\n')
+            line_buffer = bytearray(chunk[last_newline + 1:]) if chunk else bytearray()
+            for line in lines:
+                if line.startswith(b'>'):
+                    if description is not None:
+                        yield (fasta_record_id(description), description, bytes(sequence))
+                    description = bytes(line[1:]).rstrip().decode('latin-1')
+                    sequence = bytearray()
+                elif description is not None:
+                    sequence += line.rstrip(b'\r')
+            if not chunk:
+                break
+    
+    # Yield the final record
+    if description is not None:
+        yield (fasta_record_id(description), description, bytes(sequence))
+
+def fasta_line_width(fasta_file: str) -> int:
+    # Sequence line width of a FASTA file: the first line of the first record wrapped over several lines,
+    # or 0 when every record's sequence is on a single line
+    with open(fasta_file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as fasta_map:
+            file_size = len(fasta_map)
+            header_start = 0 if fasta_map[:1] == b'>' else fasta_map.find(b'\n>') + 1 or -1
+            while header_start >= 0:
+                sequence_start = fasta_map.find(b'\n', header_start) + 1
+                if sequence_start == 0:
+                    break
+                line_end = fasta_map.find(b'\n', sequence_start)
+                if line_end < 0 or line_end + 1 >= file_size:
+                    break
+                
+                # A second sequence line means the record is wrapped at its first line's width
+                if fasta_map[line_end + 1:line_end + 2] not in (b'>', b'\n', b'\r'):
+                    return len(fasta_map[sequence_start:line_end].rstrip(b'\r'))
+                header_start = fasta_map.find(b'\n>', line_end) + 1 or -1
+    
+    return 0
+
+def write_wrapped_sequence(f, sequence, line_width: int = FASTA_LINE_WIDTH):
+    # Write the sequence as lines of line_width bases (one line when line_width is 0), a block of lines at a time
+    sequence_bytes = sequence.encode('latin-1') if isinstance(sequence, str) else sequence
+    sequence_length = len(sequence_bytes)
+    if sequence_length == 0:
+        return
+    if not line_width or sequence_length <= line_width:
+        f.write(sequence_bytes)
+        f.write(b'\n')
+        return
+    
+    # Copy whole lines into a reusable block with a newline column, so no per-line objects are made
+    sequence_array = np.frombuffer(sequence_bytes, dtype=np.uint8)
+    full_lines = sequence_length // line_width
+    lines_per_block = min(max(FILE_CHUNK_SIZE // line_width, 1), full_lines)
+    line_block = np.empty((lines_per_block, line_width + 1), dtype=np.uint8)
+    line_block[:, line_width] = ord('\n')
+    for first_line in range(0, full_lines, lines_per_block):
+        block_lines = min(lines_per_block, full_lines - first_line)
+        line_block[:block_lines, :line_width] = sequence_array[first_line * line_width:(first_line + block_lines) * line_width].reshape(block_lines, line_width)
+        f.write(line_block[:block_lines])
+    if full_lines * line_width < sequence_length:
+        f.write(sequence_bytes[full_lines * line_width:])
+        f.write(b'\n')
+
+def fasta_header(record_id: str, description: str) -> str:
+    # Header line text, as SeqIO writes it: the description alone when it already starts with the ID
+    if not description:
+        return str(record_id)
+    if fasta_record_id(description) == str(record_id):
+        return description
+    
+    return f'{record_id} {description}'
+
+def write_fasta_records(fasta_records, output_file_path: str, line_width: int = FASTA_LINE_WIDTH) -> int:
+    # Stream (ID, Description, Sequence) records, e.g. from a generator, straight to a buffered file; returns the record count
+    record_count = 0
+    with open(output_file_path, 'wb', buffering=FILE_CHUNK_SIZE) as f:
+        for record_id, description, sequence in fasta_records:
+            f.write(b'>' + fasta_header(record_id, description).encode('latin-1') + b'\n')
+            write_wrapped_sequence(f, sequence, line_width)
+            record_count += 1
+    
+    return record_count
+
+def reconstruct_fna_from_df(df, output_file_path: str, line_width: int = FASTA_LINE_WIDTH):
+    # Generate an .fna file-type from a given dataframe, removing trailing spaces from each sequence
+    fasta_records = ((index, row.Description, row.Sequence.rstrip()) for index, row in zip(df.index, df.itertuples(index=False)))
+    write_fasta_records(fasta_records, output_file_path, line_width)
\ No newline at end of file
@@ -5,6 +5,8 @@ Created on Mon Apr  3 19:26:28 2023
 @author: ian.michael.bollinger@gmail.com
 """
 ### ENCODING/DECODING FUNCTIONS
+import struct
+import numpy as np
 
 # Define the tetrabin encoding scheme for nucleotides
 encoding_schemes = {'degenerate' : {'U': '0001', 'T': '0001', 'A': '0010', 'C': '0100', 'G': '1000', 
@@ -21,6 +23,96 @@ encoding_schemes = {'degenerate' : {'U': '0001', 'T': '0001', 'A': '0010', 'C':
                                     '<open3>': '1001', '<open4>': '0110',
                                     '<open5>': '1010', '<open6>': '0101',}}
 
+# 2-bit codes for the compact scheme, packed two per tetrad; kept apart from the tetrad tables above
+compact_encoding_scheme = {'A': '00', 'C': '01', 'G': '10', 'T': '11', 'U': '11'}
+
+# Record frame header: magic, version, header length (bytes, description included), sequence length (tetrads),
+# nucleotide type, encoding scheme and the raw MD5 digest, followed by the latin-1 description
+FRAME_HEADER_MAGIC = b'NBTH'
+FRAME_HEADER_VERSION = 1
+FRAME_HEADER_FORMAT = '>4sBIQBB16s'
+FRAME_HEADER_SIZE = struct.calcsize(FRAME_HEADER_FORMAT)
+FRAME_HEADER_TETRADS = 2 * FRAME_HEADER_SIZE
+NUCLEOTIDE_TYPE_IDS = {'DNA': 0, 'RNA': 1}
+ENCODING_SCHEME_IDS = {'degenerate': 0, 'confidence': 1, 'compact': 2, 'runlength': 3}
+
+# Compact sequence section: base count and exception run count, then one (start, length, byte) entry
+# per run of identical non-ACGT/U bytes, then the remaining bases packed two 2-bit codes per tetrad
+COMPACT_SECTION_FORMAT = '>QI'
+COMPACT_SECTION_TETRADS = 2 * struct.calcsize(COMPACT_SECTION_FORMAT)
+SEQUENCE_RUN_DTYPE = np.dtype([('start', '>u8'), ('length', '>u8'), ('byte', 'u1')])
+SEQUENCE_RUN_TETRADS = 2 * SEQUENCE_RUN_DTYPE.itemsize
+
+# Run-length sequence section: sequence length, mask interval and gap run counts and the inner scheme id,
+# then the (start, length) soft-masked intervals, the (start, length, byte) gap runs and the remaining
+# uppercase bases in the inner scheme
+RUNLENGTH_SECTION_FORMAT = '>QIIB'
+RUNLENGTH_SECTION_TETRADS = 2 * struct.calcsize(RUNLENGTH_SECTION_FORMAT)
+MASK_INTERVAL_DTYPE = np.dtype([('start', '>u8'), ('length', '>u8')])
+MASK_INTERVAL_TETRADS = 2 * MASK_INTERVAL_DTYPE.itemsize
+
+# Shortest run of one non-base byte (e.g. an N-gap) cut out as a gap run record
+GAP_RUN_MIN_LENGTH = 64
+
+# Tiled layout segment header: magic, record index, part offset, part length and record length (in tetrads)
+TILE_SEGMENT_MAGIC = b'NBTS'
+TILE_SEGMENT_FORMAT = '>4sIQQQ'
+TILE_SEGMENT_TETRADS = 2 * struct.calcsize(TILE_SEGMENT_FORMAT)
+
+# Marker for bytes that have no tetrad in a lookup table
+INVALID_TETRAD = 0xFF
+
+# Lowercase (confidence) and RNA characters used by the encoding check
+CONFIDENCE_CHARS = b'utacg'
+RNA_CHARS = b'Uu'
+
+def build_tetrad_lut(encoding_scheme: dict) -> np.ndarray:
+    # Map every possible byte to its tetrad nibble value, or INVALID_TETRAD
+    lut = np.full(256, INVALID_TETRAD, dtype=np.uint8)
+    for nucleotide, tetrad in encoding_scheme.items():
+        if len(nucleotide) == 1:
+            lut[ord(nucleotide)] = int(tetrad, 2)
+    
+    return lut
+
+# Byte-level lookup tables for each encoding scheme
+tetrad_luts = {encoding_key: build_tetrad_lut(encoding_scheme) for encoding_key, encoding_scheme in encoding_schemes.items()}
+tetrad_lut_bytes = {encoding_key: lut.tobytes() for encoding_key, lut in tetrad_luts.items()}
+
+# The '0'/'1' ASCII form of every nibble value, used to expand nibbles into bit strings
+nibble_bit_chars = np.array([[ord(bit) for bit in format(nibble, '04b')] for nibble in range(16)], dtype=np.uint8)
+
+# Byte written for tetrads that have no single-character nucleotide (the confidence '<open>' slots)
+UNDEFINED_NUCLEOTIDE = b'?'
+
+def build_nucleotide_lut(encoding_scheme: dict, nucleotide_type: str) -> bytes:
+    # 256-entry bytes.translate table from a tetrad nibble (or compact code) value to its nucleotide byte; RNA tables decode T/t as U/u
+    lut = bytearray(UNDEFINED_NUCLEOTIDE * 256)
+    for nucleotide, tetrad in encoding_scheme.items():
+        if len(nucleotide) == 1 and nucleotide not in 'Uu':
+            lut[int(tetrad, 2)] = ord(nucleotide)
+    if nucleotide_type == 'RNA':
+        lut = lut.translate(bytes.maketrans(b'Tt', b'Uu'))
+    
+    return bytes(lut)
+
+# Decoding tables for every encoding scheme and nucleotide type
+nucleotide_luts = {(encoding_key, nucleotide_type): build_nucleotide_lut(encoding_scheme, nucleotide_type)
+                   for encoding_key, encoding_scheme in encoding_schemes.items() for nucleotide_type in ('DNA', 'RNA')}
+nucleotide_luts.update({('compact', nucleotide_type): build_nucleotide_lut(compact_encoding_scheme, nucleotide_type) for nucleotide_type in ('DNA', 'RNA')})
+
+def build_compact_code_lut(nucleotide_type: str) -> bytes:
+    # 256-entry bytes.translate table from a base to its 2-bit compact code; T is a base in DNA and U in RNA, anything else is an exception
+    lut = bytearray([INVALID_TETRAD]) * 256
+    for nucleotide, code in compact_encoding_scheme.items():
+        if nucleotide != ('T' if nucleotide_type == 'RNA' else 'U'):
+            lut[ord(nucleotide)] = int(code, 2)
+    
+    return bytes(lut)
+
+# Compact encoding tables for each nucleotide type
+compact_code_luts = {nucleotide_type: build_compact_code_lut(nucleotide_type) for nucleotide_type in ('DNA', 'RNA')}
+
 def reverse_dict(input_dict: dict) -> dict:
     # Reverse the Keys and Values for a given Dictionary
     reversed_dict = {v: k for k, v in input_dict.items()}
@@ -28,6 +120,13 @@ def reverse_dict(input_dict: dict) -> dict:
     return reversed_dict
 
 
+# Reversed encoding schemes, built once for tetra_bin_decode
+tetrabin_decoding_schemes = {encoding_key: reverse_dict(encoding_scheme) for encoding_key, encoding_scheme in encoding_schemes.items()}
+
+# Frame header ids back to their names
+nucleotide_type_names = reverse_dict(NUCLEOTIDE_TYPE_IDS)
+encoding_scheme_names = reverse_dict(ENCODING_SCHEME_IDS)
+
 def ascii_bin_decode(input_string) -> str:
     # Split the binary string into groups of 8 bits
     byte_list = [input_string[i:i+8] for i in range(0, len(input_string), 8)]
@@ -51,43 +150,480 @@ def ascii_bin_encode(input_string: str):
     return encoded_ascii_bin
 
 
-def tetra_bin_encode(input_sequence: str) -> (str, str, str): 
+def bytes_to_nibbles(byte_array: np.ndarray) -> np.ndarray:
+    # Split each byte into its high and low nibbles
+    return np.stack((byte_array >> 4, byte_array & 0x0F), axis=1).reshape(-1)
+
+def nibbles_to_bytes(nibbles: np.ndarray) -> bytes:
+    # Join nibble pairs back into bytes (high nibble first), padding an odd count with a zero nibble
+    if len(nibbles) % 2:
+        nibbles = np.append(nibbles, np.uint8(0))
+    
+    return ((nibbles[0::2] << 4) | nibbles[1::2]).astype(np.uint8).tobytes()
+
+def sequence_to_bytes(input_sequence) -> bytes:
+    # Get the raw bytes of a sequence given as str, bytes or a buffer view
+    if isinstance(input_sequence, str):
+        return input_sequence.encode('latin-1')
+    
+    return bytes(input_sequence)
+
+def fasta_encoding_check_bytes(sequence_bytes: bytes) -> (str, str):
+    # Byte-level version of fasta_encoding_check; each membership test is a single memchr scan
+    if any(char in sequence_bytes for char in CONFIDENCE_CHARS):
+        encoding_key = 'confidence'
+    else:
+        encoding_key = 'degenerate'
+    
+    if any(char in sequence_bytes for char in RNA_CHARS):
+        nucleotide_type = 'RNA'
+    else:
+        nucleotide_type = 'DNA'
+    
+    return (encoding_key, nucleotide_type)
+
+def thymine_uracil_mixed(sequence_bytes: bytes, nucleotide_type: str) -> bool:
+    # The tetrad tables give T and U one code, decoded as U in RNA, so an RNA sequence holding T would not round-trip through them
+    return nucleotide_type == 'RNA' and (b'T' in sequence_bytes or b't' in sequence_bytes)
+
+def find_byte_runs(sequence_array: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    # (start, length, byte) runs of the same byte at consecutive positions among the given sorted positions
+    run_bytes = sequence_array[positions]
+    run_starts = np.ones(positions.size, dtype=bool)
+    run_starts[1:] = (np.diff(positions) != 1) | (run_bytes[1:] != run_bytes[:-1])
+    run_indices = np.flatnonzero(run_starts)
+    byte_runs = np.empty(run_indices.size, dtype=SEQUENCE_RUN_DTYPE)
+    byte_runs['start'] = positions[run_indices]
+    byte_runs['length'] = np.diff(np.append(run_indices, positions.size))
+    byte_runs['byte'] = run_bytes[run_indices]
+    
+    return byte_runs
+
+def compact_nibble_encode(sequence_bytes: bytes, nucleotide_type: str, require_smaller: bool = True) -> np.ndarray:
+    # Compact sequence section nibbles, or None when the exceptions are not all degenerate characters
+    # or the section would not be smaller than one tetrad per base (if required)
+    sequence_codes = np.frombuffer(sequence_bytes.translate(compact_code_luts[nucleotide_type]), dtype=np.uint8)
+    exception_mask = sequence_codes == INVALID_TETRAD
+    exception_positions = np.flatnonzero(exception_mask)
+    
+    # Runs of the same exception byte at consecutive positions
+    sequence_array = np.frombuffer(sequence_bytes, dtype=np.uint8)
+    if np.any(tetrad_luts['degenerate'][sequence_array[exception_positions]] == INVALID_TETRAD):
+        return None
+    exception_runs = find_byte_runs(sequence_array, exception_positions)
+    
+    base_count = len(sequence_bytes) - exception_positions.size
+    section_tetrads = COMPACT_SECTION_TETRADS + SEQUENCE_RUN_TETRADS * exception_runs.size + (base_count + 1) // 2
+    if require_smaller and section_tetrads >= len(sequence_bytes):
+        return None
+    
+    # Pack the bases (exceptions removed) two codes per tetrad, high code first
+    base_codes = sequence_codes[~exception_mask] if exception_positions.size else sequence_codes
+    if base_codes.size % 2:
+        base_codes = np.append(base_codes, np.uint8(0))
+    section_header = struct.pack(COMPACT_SECTION_FORMAT, len(sequence_bytes), exception_runs.size)
+    
+    return np.concatenate((bytes_to_nibbles(np.frombuffer(section_header + exception_runs.tobytes(), dtype=np.uint8)),
+                           (base_codes[0::2] << 2) | base_codes[1::2]))
+
+def compact_nibble_decode(section_nibbles: np.ndarray, nucleotide_type: str) -> bytes:
+    # Unpack the bases of a compact sequence section and put the exception runs back in place
+    sequence_length, run_count = struct.unpack(COMPACT_SECTION_FORMAT, nibbles_to_bytes(section_nibbles[:COMPACT_SECTION_TETRADS]))
+    runs_end = COMPACT_SECTION_TETRADS + SEQUENCE_RUN_TETRADS * run_count
+    exception_runs = np.frombuffer(nibbles_to_bytes(section_nibbles[COMPACT_SECTION_TETRADS:runs_end]), dtype=SEQUENCE_RUN_DTYPE)
+    base_count = sequence_length - int(exception_runs['length'].sum())
+    
+    packed_bases = np.asarray(section_nibbles[runs_end:], dtype=np.uint8)
+    base_codes = np.empty(2 * packed_bases.size, dtype=np.uint8)
+    base_codes[0::2] = packed_bases >> 2
+    base_codes[1::2] = packed_bases & 3
+    if base_codes.size < base_count:
+        raise ValueError(f'Compact section holds {base_codes.size} bases; its header needs {base_count}')
+    base_bytes = base_codes[:base_count].tobytes().translate(nucleotide_luts[('compact', nucleotide_type)])
+    if run_count == 0:
+        return base_bytes
+    
+    sequence = np.empty(sequence_length, dtype=np.uint8)
+    exception_mask = np.zeros(sequence_length, dtype=bool)
+    for run_start, run_length, run_byte in exception_runs.tolist():
+        sequence[run_start:run_start + run_length] = run_byte
+        exception_mask[run_start:run_start + run_length] = True
+    sequence[~exception_mask] = np.frombuffer(base_bytes, dtype=np.uint8)
+    
+    return sequence.tobytes()
+
+def runlength_nibble_encode(sequence_bytes: bytes, nucleotide_type: str, soft_masked: bool, require_smaller: bool = True) -> np.ndarray:
+    # Run-length sequence section nibbles: soft-masked intervals and long gap runs are stored as records and only
+    # the remaining uppercase bases go through the compact or degenerate table; None when that is not smaller (if required)
+    sequence_array = np.frombuffer(sequence_bytes, dtype=np.uint8)
+    mask_intervals = np.empty(0, dtype=MASK_INTERVAL_DTYPE)
+    if soft_masked:
+        lowercase_edges = np.diff((sequence_array >= ord('a')) & (sequence_array <= ord('z')), prepend=False, append=False).nonzero()[0]
+        mask_intervals = np.empty(lowercase_edges.size // 2, dtype=MASK_INTERVAL_DTYPE)
+        mask_intervals['start'] = lowercase_edges[0::2]
+        mask_intervals['length'] = lowercase_edges[1::2] - lowercase_edges[0::2]
+        sequence_bytes = sequence_bytes.upper()
+        sequence_array = np.frombuffer(sequence_bytes, dtype=np.uint8)
+    
+    # Long runs of one byte that is not a base, such as scaffold N-gaps
+    gap_positions = np.flatnonzero(np.frombuffer(sequence_bytes.translate(compact_code_luts[nucleotide_type]), dtype=np.uint8) == INVALID_TETRAD)
+    gap_runs = find_byte_runs(sequence_array, gap_positions)
+    gap_runs = gap_runs[gap_runs['length'] >= GAP_RUN_MIN_LENGTH]
+    if mask_intervals.size == 0 and gap_runs.size == 0:
+        return None
+    if gap_runs.size:
+        kept_bases = np.ones(sequence_array.size, dtype=bool)
+        for run_start, run_length, _ in gap_runs.tolist():
+            kept_bases[run_start:run_start + run_length] = False
+        sequence_bytes = sequence_array[kept_bases].tobytes()
+    
+    # The remaining bases use the compact table when they are plain enough, otherwise the degenerate one
+    inner_nibbles = compact_nibble_encode(sequence_bytes, nucleotide_type)
+    inner_key = 'compact'
+    if inner_nibbles is None:
+        inner_key = 'degenerate'
+        inner_nibbles = np.frombuffer(sequence_bytes.translate(tetrad_lut_bytes[inner_key]), dtype=np.uint8)
+        if INVALID_TETRAD in inner_nibbles or thymine_uracil_mixed(sequence_bytes, nucleotide_type):
+            # Bases the degenerate table cannot hold exactly still fit a compact section that is not smaller
+            inner_key = 'compact'
+            inner_nibbles = compact_nibble_encode(sequence_bytes, nucleotide_type, require_smaller=False)
+            if inner_nibbles is None:
+                return None
+    
+    section_tetrads = RUNLENGTH_SECTION_TETRADS + MASK_INTERVAL_TETRADS * mask_intervals.size + SEQUENCE_RUN_TETRADS * gap_runs.size + inner_nibbles.size
+    if require_smaller and section_tetrads >= sequence_array.size:
+        return None
+    section_header = struct.pack(RUNLENGTH_SECTION_FORMAT, sequence_array.size, mask_intervals.size, gap_runs.size, ENCODING_SCHEME_IDS[inner_key])
+    
+    return np.concatenate((bytes_to_nibbles(np.frombuffer(section_header + mask_intervals.tobytes() + gap_runs.tobytes(), dtype=np.uint8)), inner_nibbles))
+
+def runlength_nibble_decode(section_nibbles: np.ndarray, nucleotide_type: str) -> bytes:
+    # Decode the inner bases, then put the gap runs back in place and lowercase the soft-masked intervals
+    sequence_length, interval_count, run_count, inner_scheme_id = struct.unpack(RUNLENGTH_SECTION_FORMAT, nibbles_to_bytes(section_nibbles[:RUNLENGTH_SECTION_TETRADS]))
+    intervals_end = RUNLENGTH_SECTION_TETRADS + MASK_INTERVAL_TETRADS * interval_count
+    runs_end = intervals_end + SEQUENCE_RUN_TETRADS * run_count
+    mask_intervals = np.frombuffer(nibbles_to_bytes(section_nibbles[RUNLENGTH_SECTION_TETRADS:intervals_end]), dtype=MASK_INTERVAL_DTYPE)
+    gap_runs = np.frombuffer(nibbles_to_bytes(section_nibbles[intervals_end:runs_end]), dtype=SEQUENCE_RUN_DTYPE)
+    if inner_scheme_id not in encoding_scheme_names or encoding_scheme_names[inner_scheme_id] == 'runlength':
+        raise ValueError(f'Unknown inner encoding scheme {inner_scheme_id}')
+    inner_bytes = tetra_nibble_decode(section_nibbles[runs_end:], encoding_scheme_names[inner_scheme_id], nucleotide_type)
+    
+    sequence = np.empty(sequence_length, dtype=np.uint8)
+    if gap_runs.size:
+        gap_mask = np.zeros(sequence_length, dtype=bool)
+        for run_start, run_length, run_byte in gap_runs.tolist():
+            sequence[run_start:run_start + run_length] = run_byte
+            gap_mask[run_start:run_start + run_length] = True
+        sequence[~gap_mask] = np.frombuffer(inner_bytes, dtype=np.uint8)
+    else:
+        sequence[:] = np.frombuffer(inner_bytes, dtype=np.uint8)
+    for interval_start, interval_length in mask_intervals.tolist():
+        sequence[interval_start:interval_start + interval_length] |= 0x20
+    
+    return sequence.tobytes()
+
+def tetra_nibble_encode(input_sequence, packed_sections: bool = True) -> (np.ndarray, str, str):
+    # Without packed_sections only the one-tetrad-per-base degenerate and confidence tables are used
+    # Get the sequence bytes without any new line characters
+    sequence_bytes = sequence_to_bytes(input_sequence)
+    if b'\n' in sequence_bytes or b'\r' in sequence_bytes:
+        sequence_bytes = sequence_bytes.translate(None, b'\r\n')
+    
     # Determine encoding scheme based on contents
-    encoding_key, nucleotide_type = fasta_encoding_check(input_sequence)
-    encoding_scheme = encoding_schemes[encoding_key]
+    encoding_key, nucleotide_type = fasta_encoding_check_bytes(sequence_bytes)
     
-    # Remove any new line characters
-    input_sequence = input_sequence.replace('\n','')
-       
-    # Encode the nucleotide sequence using tetrabin encoding
-    try:
-        encoded_sequence = ''.join(encoding_scheme[n] for n in input_sequence)
-    except KeyError:
-        print(f'Invalid degenerate nucleotide sequence: {input_sequence}\nTrying confidence encoding')
-        try:
-            encoding_scheme = encoding_schemes['confidence']
-            encoded_sequence = ''.join(encoding_scheme[n] for n in input_sequence)
-        except KeyError:            
-            print(f'Invalid nucleotide sequence: {input_sequence}\nTrying confidence encoding')
-            return None
+    # Uppercase sequences pack two bases per tetrad when their exceptions (N-runs, IUPAC codes) are few enough to pay off
+    if packed_sections and encoding_key == 'degenerate':
+        compact_nibbles = compact_nibble_encode(sequence_bytes, nucleotide_type)
+        if compact_nibbles is not None:
+            return (compact_nibbles, nucleotide_type, 'compact')
+    
+    # Soft-masked intervals and long N-gaps become run-length records, leaving only the mixed spans to the tables
+    # Any lowercase byte (soft-masked n or IUPAC codes too, not only acgtu) counts as soft-masking
+    runlength_nibbles = runlength_nibble_encode(sequence_bytes, nucleotide_type, not sequence_bytes.isupper()) if packed_sections else None
+    if runlength_nibbles is not None:
+        return (runlength_nibbles, nucleotide_type, 'runlength')
+    
+    # Map every nucleotide byte to its tetrad nibble, falling back to the other scheme on invalid bytes
+    # RNA holding T skips the tables, which would turn every T into U
+    if not thymine_uracil_mixed(sequence_bytes, nucleotide_type):
+        for candidate_key in (encoding_key, 'confidence', 'degenerate'):
+            encoded_bytes = sequence_bytes.translate(tetrad_lut_bytes[candidate_key])
+            if INVALID_TETRAD not in encoded_bytes:
+                return (np.frombuffer(encoded_bytes, dtype=np.uint8), nucleotide_type, candidate_key)
+    
+    # Records the tables cannot hold exactly (mixed T/U, lowercase n or IUPAC codes) still fit a compact
+    # or run-length section, even one that is not smaller
+    if packed_sections:
+        compact_nibbles = compact_nibble_encode(sequence_bytes, nucleotide_type, require_smaller=False)
+        if compact_nibbles is not None:
+            return (compact_nibbles, nucleotide_type, 'compact')
+        runlength_nibbles = runlength_nibble_encode(sequence_bytes, nucleotide_type, True, require_smaller=False)
+        if runlength_nibbles is not None:
+            return (runlength_nibbles, nucleotide_type, 'runlength')
+    
+    valid_bytes = np.flatnonzero(tetrad_luts[encoding_key] != INVALID_TETRAD).tolist()
+    invalid_chars = bytes(sorted(set(sequence_bytes) - set(valid_bytes))).decode('latin-1')
+    if invalid_chars:
+        print(f'Invalid nucleotide sequence characters: {invalid_chars!r}')
+    else:
+        print('Sequence mixes T and U, which the degenerate and confidence tables cannot tell apart')
+    return None
+
+def nibbles_to_bin_string(encoded_nibbles: np.ndarray) -> str:
+    # Expand each nibble value into its four '0'/'1' characters
+    return nibble_bit_chars[encoded_nibbles].tobytes().decode('ascii')
+
+def tetra_bin_encode(input_sequence: str) -> (str, str, str): 
+    # Encode through the byte lookup tables and expand to the tetrabin bit string
+    # The bit string holds one tetrad per base, so the compact and run-length sections are never used here
+    encoded_result = tetra_nibble_encode(input_sequence, packed_sections=False)
+    if encoded_result is None:
+        return None
+    
+    encoded_nibbles, nucleotide_type, encoding_key = encoded_result
+    encoded_sequence = nibbles_to_bin_string(encoded_nibbles)
         
     return(encoded_sequence, nucleotide_type, encoding_key)
 
+def tetra_nibble_decode(sequence_nibbles: np.ndarray, encoding_key: str, nucleotide_type: str = 'DNA') -> bytes:
+    # Decode tetrad nibbles to nucleotide bytes in one table lookup pass; compact and run-length sections unpack their records first
+    if encoding_key == 'compact':
+        return compact_nibble_decode(sequence_nibbles, nucleotide_type)
+    if encoding_key == 'runlength':
+        return runlength_nibble_decode(sequence_nibbles, nucleotide_type)
+    
+    return np.ascontiguousarray(sequence_nibbles, dtype=np.uint8).tobytes().translate(nucleotide_luts[(encoding_key, nucleotide_type)])
+
 def tetra_bin_decode(final_encoded_string: str, encoding_scheme: dict) -> str:
     # Tetrabin decoding scheme
-    tetrabin_decoding_scheme = reverse_dict(encoding_schemes[encoding_scheme])
+    tetrabin_decoding_scheme = tetrabin_decoding_schemes[encoding_scheme]
 
     # Decode the description and sequence
     decoded_sequence = ''.join(tetrabin_decoding_scheme[final_encoded_string[i:i+4]] for i in range(0, len(final_encoded_string), 4))
     return decoded_sequence
 
+def pack_frame_header(description: str, sequence_tetrads: int, nucleotide_type: str, encoding_key: str, md5_checksum: str) -> bytes:
+    # Fixed-offset binary header for a record frame, followed by its description
+    description_bytes = description.encode('latin-1')
+    
+    return struct.pack(FRAME_HEADER_FORMAT, FRAME_HEADER_MAGIC, FRAME_HEADER_VERSION, FRAME_HEADER_SIZE + len(description_bytes),
+                       sequence_tetrads, NUCLEOTIDE_TYPE_IDS[nucleotide_type], ENCODING_SCHEME_IDS[encoding_key], bytes.fromhex(md5_checksum)) + description_bytes
+
+def unpack_frame_header(header_bytes: bytes) -> (int, int, str, str, str):
+    # Read the fixed header fields: (header length, sequence tetrads, nucleotide type, encoding key, md5 checksum)
+    if len(header_bytes) < FRAME_HEADER_SIZE:
+        raise ValueError('Payload is shorter than the frame header')
+    magic, version, header_length, sequence_tetrads, nucleotide_type_id, encoding_scheme_id, md5_digest = struct.unpack_from(FRAME_HEADER_FORMAT, header_bytes)
+    if magic != FRAME_HEADER_MAGIC:
+        raise ValueError('Payload does not start with a frame header')
+    if version != FRAME_HEADER_VERSION:
+        raise ValueError(f'Unsupported frame header version {version}')
+    if header_length < FRAME_HEADER_SIZE:
+        raise ValueError(f'Frame header length {header_length} is shorter than its fixed fields')
+    if nucleotide_type_id not in nucleotide_type_names or encoding_scheme_id not in encoding_scheme_names:
+        raise ValueError(f'Unknown nucleotide type {nucleotide_type_id} or encoding scheme {encoding_scheme_id}')
+    
+    return (header_length, sequence_tetrads, nucleotide_type_names[nucleotide_type_id], encoding_scheme_names[encoding_scheme_id], md5_digest.hex())
+
+def payload_tetrad_count(payload_nibbles: np.ndarray) -> int:
+    # Total tetrads of the record payload starting at these nibbles, read from its header; None if they hold no frame header
+    try:
+        header_length, sequence_tetrads, _, _, _ = unpack_frame_header(nibbles_to_bytes(payload_nibbles[:FRAME_HEADER_TETRADS]))
+    except (ValueError, struct.error):
+        return None
+    
+    return 2 * header_length + sequence_tetrads
+
+def encode_record_sequence(description: str, sequence) -> (np.ndarray, str, str):
+    # tetra_nibble_encode for a FASTA record, raising ValueError when no encoding scheme accepts it
+    encoded_result = tetra_nibble_encode(sequence)
+    if encoded_result is None:
+        raise ValueError(f'Record {description!r} holds characters no encoding scheme accepts')
+    
+    return encoded_result
+
+class TetradPayload:
+    # Bit-packed frame payload: the binary frame header bytes plus one uint8 nibble per sequence tetrad
+    __slots__ = ('header', 'sequence_nibbles')
+    
+    def __init__(self, header: bytes, sequence_nibbles: np.ndarray):
+        self.header = bytes(header)
+        self.sequence_nibbles = sequence_nibbles
+    
+    @classmethod
+    def from_nibbles(cls, payload_nibbles: np.ndarray):
+        # Rebuild a payload from its flat nibbles; the header gives its own length and the sequence length, so nothing is scanned
+        header_length, sequence_tetrads, _, _, _ = unpack_frame_header(nibbles_to_bytes(payload_nibbles[:FRAME_HEADER_TETRADS]))
+        sequence_start = 2 * header_length
+        if len(payload_nibbles) < sequence_start + sequence_tetrads:
+            raise ValueError(f'Payload holds {len(payload_nibbles)} tetrads; its header needs {sequence_start + sequence_tetrads}')
+        
+        return cls(nibbles_to_bytes(payload_nibbles[:sequence_start]), payload_nibbles[sequence_start:sequence_start + sequence_tetrads])
+    
+    @classmethod
+    def from_record(cls, description: str, sequence, md5_checksum: str, encoded_result: tuple = None):
+        # Encode a FASTA record as its binary frame header followed by the sequence tetrads,
+        # or frame an already encoded (sequence nibbles, nucleotide type, encoding key) result
+        sequence_nibbles, nucleotide_type, encoding_key = encoded_result or encode_record_sequence(description, sequence)
+        
+        return cls(pack_frame_header(description, len(sequence_nibbles), nucleotide_type, encoding_key, md5_checksum), sequence_nibbles)
+    
+    def __len__(self) -> int:
+        # Number of tetrads (pixels) in the payload; each header byte takes two
+        return 2 * len(self.header) + len(self.sequence_nibbles)
+    
+    def header_fields(self) -> (str, str, str, str):
+        # Read the description, md5, nucleotide type and encoding key at their fixed offsets
+        header_length, _, nucleotide_type, encoding_key, md5_checksum = unpack_frame_header(self.header)
+        id_desc = self.header[FRAME_HEADER_SIZE:header_length].decode('latin-1')
+        
+        return (id_desc, md5_checksum, nucleotide_type, encoding_key)
+    
+    def segments(self):
+        # Yield (tetrad offset, nibble array) pieces so callers can place them without concatenating
+        header_nibbles = bytes_to_nibbles(np.frombuffer(self.header, dtype=np.uint8))
+        yield (0, header_nibbles)
+        yield (len(header_nibbles), self.sequence_nibbles)
+    
+    def to_nibbles(self) -> np.ndarray:
+        # Flat copy of the payload nibbles
+        return np.concatenate([nibbles for _, nibbles in self.segments()])
+
+class TiledFramePayload:
+    # One frame of the tiled layout: record parts, each preceded by its segment header
+    __slots__ = ('parts',)
+    
+    def __init__(self, parts: list):
+        # parts holds (record index, part offset, record length, part nibbles)
+        self.parts = parts
+    
+    def __len__(self) -> int:
+        return sum(TILE_SEGMENT_TETRADS + len(part_nibbles) for _, _, _, part_nibbles in self.parts)
+    
+    def segments(self):
+        # Yield (tetrad offset, nibble array) pieces: each segment header followed by its part
+        offset = 0
+        for record_index, part_offset, record_length, part_nibbles in self.parts:
+            segment_header = struct.pack(TILE_SEGMENT_FORMAT, TILE_SEGMENT_MAGIC, record_index, part_offset, len(part_nibbles), record_length)
+            yield (offset, bytes_to_nibbles(np.frombuffer(segment_header, dtype=np.uint8)))
+            yield (offset + TILE_SEGMENT_TETRADS, part_nibbles)
+            offset += TILE_SEGMENT_TETRADS + len(part_nibbles)
+
+def tile_frame_capacity(canvas_side: int) -> int:
+    # Tetrads that fit a frame whose centered block may span the whole canvas side
+    return (canvas_side - 1) ** 2
+
+def plan_tile_layout(tetrad_counts: list, frame_capacity: int) -> list:
+    # Cut the stream of record payloads into frames of at most frame_capacity tetrads (segment headers included);
+    # small records share a frame and large ones are split, giving per frame a list of (record index, part offset, part length)
+    if frame_capacity <= TILE_SEGMENT_TETRADS:
+        raise ValueError(f'Frames of {frame_capacity} tetrads cannot hold a {TILE_SEGMENT_TETRADS}-tetrad segment header')
+    
+    tile_layout = []
+    frame_parts = []
+    remaining = frame_capacity
+    for record_index, tetrad_total in enumerate(tetrad_counts):
+        part_offset = 0
+        while part_offset < tetrad_total:
+            if remaining <= TILE_SEGMENT_TETRADS:
+                tile_layout.append(frame_parts)
+                frame_parts = []
+                remaining = frame_capacity
+            part_length = min(tetrad_total - part_offset, remaining - TILE_SEGMENT_TETRADS)
+            frame_parts.append((record_index, part_offset, part_length))
+            remaining -= TILE_SEGMENT_TETRADS + part_length
+            part_offset += part_length
+    if frame_parts:
+        tile_layout.append(frame_parts)
+    
+    return tile_layout
+
+def iter_tiled_frames(record_payloads, tile_layout: list):
+    # Stream TiledFramePayloads for the layout, holding at most the records that span the current frame
+    record_nibbles = {}
+    record_payloads = iter(record_payloads)
+    next_record = 0
+    for frame_parts in tile_layout:
+        parts = []
+        for record_index, part_offset, part_length in frame_parts:
+            while next_record <= record_index:
+                record_nibbles[next_record] = next(record_payloads).to_nibbles()
+                next_record += 1
+            nibbles = record_nibbles[record_index]
+            parts.append((record_index, part_offset, len(nibbles), nibbles[part_offset:part_offset + part_length]))
+            
+            # Release a record once its last part is placed
+            if part_offset + part_length == len(nibbles):
+                del record_nibbles[record_index]
+        yield TiledFramePayload(parts)
+
+def frame_payload_tetrads(frame_nibbles: np.ndarray) -> int:
+    # Tetrads of data at the start of a frame block, read from its headers: a record frame header,
+    # or the chain of tiled segment headers; None if the block starts with neither
+    payload_tetrads = payload_tetrad_count(frame_nibbles)
+    if payload_tetrads is not None:
+        return payload_tetrads
+    
+    position = 0
+    while position + TILE_SEGMENT_TETRADS <= len(frame_nibbles):
+        segment_header = nibbles_to_bytes(frame_nibbles[position:position + TILE_SEGMENT_TETRADS])
+        magic, _, _, part_length, _ = struct.unpack(TILE_SEGMENT_FORMAT, segment_header)
+        if magic != TILE_SEGMENT_MAGIC:
+            break
+        position += TILE_SEGMENT_TETRADS + part_length
+    
+    return position or None
+
+def parse_tiled_frame(frame_nibbles: np.ndarray) -> list:
+    # Split a decoded tiled frame back into (record index, part offset, record length, part nibbles)
+    parts = []
+    position = 0
+    while position + TILE_SEGMENT_TETRADS <= len(frame_nibbles):
+        segment_header = nibbles_to_bytes(frame_nibbles[position:position + TILE_SEGMENT_TETRADS])
+        magic, record_index, part_offset, part_length, record_length = struct.unpack(TILE_SEGMENT_FORMAT, segment_header)
+        if magic != TILE_SEGMENT_MAGIC:
+            break
+        position += TILE_SEGMENT_TETRADS
+        parts.append((record_index, part_offset, record_length, frame_nibbles[position:position + part_length]))
+        position += part_length
+    
+    return parts
+
+def reassemble_tiled_records(frame_parts):
+    # Collect parsed frame parts (in frame order) and yield (record index, TetradPayload) as each record completes
+    record_buffers = {}
+    for record_index, part_offset, record_length, part_nibbles in frame_parts:
+        if record_index not in record_buffers:
+            record_buffers[record_index] = [np.zeros(record_length, dtype=np.uint8), 0]
+        record_buffer = record_buffers[record_index]
+        record_buffer[0][part_offset:part_offset + len(part_nibbles)] = part_nibbles
+        record_buffer[1] += len(part_nibbles)
+        if record_buffer[1] == record_length:
+            del record_buffers[record_index]
+            yield (record_index, TetradPayload.from_nibbles(record_buffer[0]))
+
+def tetra_record_encode(description: str, sequence, md5_checksum: str, encoded_result: tuple = None) -> TetradPayload:
+    # Encode a FASTA record into a TetradPayload, reusing encoded_result when the sequence was already encoded
+    return TetradPayload.from_record(description, sequence, md5_checksum, encoded_result)
+
+def tetrad_segments(data):
+    # Yield (tetrad offset, nibble array) pieces of a payload, '0'/'1' string or nibble array
+    if isinstance(data, (TetradPayload, TiledFramePayload)):
+        yield from data.segments()
+    elif isinstance(data, str):
+        bits = np.frombuffer(data.encode('ascii'), dtype=np.uint8) - ord('0')
+        yield (0, bits[:len(bits) - len(bits) % 4].reshape(-1, 4) @ np.array([8, 4, 2, 1], dtype=np.uint8))
+    else:
+        yield (0, np.asarray(data, dtype=np.uint8))
+
 def fasta_encoding_check(input_sequence: str) -> (str, str):   
     # Determine if case-based (confidence) nucleotide data
     if any(char in input_sequence for char in ['u', 't', 'a', 'c', 'g']):
         encoding_key = 'confidence'
 
-    # Determine if letter-based (degenerate) nucleotide data
-    elif any(char in input_sequence for char in ['R', 'Y', 'K', 'M', 'S', 'W', 'B', 'D', 'H', 'V', 'N']):
+    # Letter-based (degenerate) and plain uppercase nucleotide data use the degenerate scheme
+    else:
         encoding_key = 'degenerate'
         
     # Determine the type of nucleotide (DNA or RNA) in the sequence
@@ -106,34 +642,24 @@ if __name__ == '__main__':
     # dna_seq_conf = 'taCGTAcg'
     rna_seq_conf = 'uaCGUAcg'
     
-    test_id_desc = '>200001.1 Example Organism'
-    md5_test = 'asd3f578e53asdf5'
-    
-    input_sequence = rna_seq_conf
-    
-    encoded_binary, nucleotide_type, encoded_key = tetra_bin_encode(input_sequence)
+    # RNA that also holds a T, which only the compact section keeps exactly
+    rna_seq_mixed = 'ACGUACGTACGUAAUUGGCC'
     
-    md5_desc_type_enc = f'{test_id_desc}<{md5_test}<{nucleotide_type}<{encoded_key}<'
-    
-    encoded_ascii_bin = ascii_bin_encode(md5_desc_type_enc)
-    
-    final_encoded_string = encoded_ascii_bin + encoded_binary
-    
-    encoded_string_split = final_encoded_string.split(ascii_bin_encode('<'), maxsplit = 4)
+    test_id_desc = '>200001.1 Example Organism'
+    md5_test = 'a3d3f578e53a0df5a3d3f578e53a0df5'
     
-    decoded_id_desc = ascii_bin_decode(encoded_string_split[0])
-    decoded_md5 = ascii_bin_decode(encoded_string_split[1])
-    decoded_nucleotide_type = ascii_bin_decode(encoded_string_split[2])
-    decoded_encoding_key = ascii_bin_decode(encoded_string_split[3])
+    module_qc_passed = True
+    for input_sequence in (rna_seq_conf, rna_seq_mixed):
+        # Encode the record, flatten it to nibbles and read it back through the frame header
+        encoded_payload = tetra_record_encode(test_id_desc, input_sequence, md5_test)
+        decoded_payload = TetradPayload.from_nibbles(encoded_payload.to_nibbles())
+        
+        decoded_id_desc, decoded_md5, decoded_nucleotide_type, decoded_encoding_key = decoded_payload.header_fields()
+        decoded_sequence = tetra_nibble_decode(decoded_payload.sequence_nibbles, decoded_encoding_key, decoded_nucleotide_type).decode('latin-1')
+        
+        if test_id_desc != decoded_id_desc or md5_test != decoded_md5 or input_sequence != decoded_sequence:
+            print(f'MODULE QC CHECK FAILED FOR {input_sequence} ({decoded_encoding_key})')
+            module_qc_passed = False
     
-    decoded_sequence = tetra_bin_decode(encoded_string_split[4], decoded_encoding_key)
-    if decoded_nucleotide_type == 'RNA':
-        if decoded_encoding_key == 'degenerate':
-            decoded_sequence = decoded_sequence.replace('T','U')
-        else:
-            decoded_sequence = decoded_sequence.replace('t','u').replace('T','U')
-            
-    if test_id_desc == decoded_id_desc:
-        if md5_test == decoded_md5:
-            if input_sequence == decoded_sequence:
-                print('ALL MODULE QC CHECKS PASSED')
\ No newline at end of file
+    if module_qc_passed:
+        print('ALL MODULE QC CHECKS PASSED')
\ No newline at end of file
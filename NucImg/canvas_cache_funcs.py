@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:48:27 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
+### BASE CANVAS CACHE FUNCTIONS
+import os
+import numpy as np
+import PIL
+from PIL import Image
+
+from CustFasta.custom_fasta_funcs import md5_checksum
+
+# Constants
+CANVAS_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), '.cache', 'nucleotide_binary_tetrad', 'canvases')
+CANVAS_CACHE_MAX_BYTES = 2 << 30
+CANVAS_RECIPE_VERSION = 1
+PALETTE_COLORS = 256
+
+def center_on_canvas(img: Image, output_width: int, output_height: int) -> Image:
+    # Paste the image centered on a white RGBA canvas of the given size
+    new_image = Image.new('RGBA', (output_width, output_height), (255, 255, 255, 255))
+    img_width, img_height = img.size
+    left = (output_width - img_width) // 2
+    top = (output_height - img_height) // 2
+    right = (output_width + img_width) // 2
+    bottom = (output_height + img_height) // 2
+    new_image.paste(img, (left, top, right, bottom))
+    
+    return new_image
+
+def prepare_base_canvas(image_path: str, width: int, height: int) -> np.ndarray:
+    # Quantize the artwork to a 256-color palette and center it on the canvas, as an (H, W, 4) RGBA array
+    palette_image = Image.open(image_path).convert("P", palette=Image.ADAPTIVE, colors=PALETTE_COLORS)
+    
+    return np.asarray(center_on_canvas(palette_image, width, height).convert("RGBA"))
+
+def canvas_cache_key(image_path: str, width: int, height: int) -> str:
+    # Content address: the artwork's checksum, the canvas size, and the recipe and Pillow versions that shape the result
+    return f'{md5_checksum(image_path)}_{width}x{height}_v{CANVAS_RECIPE_VERSION}_pil{PIL.__version__}'
+
+def evict_canvas_cache(cache_directory: str, max_bytes: int):
+    # Remove the least recently used canvases until the cache fits in max_bytes
+    cache_entries = []
+    for file_name in os.listdir(cache_directory):
+        if file_name.endswith('.npy'):
+            file_stat = os.stat(os.path.join(cache_directory, file_name))
+            cache_entries.append((file_stat.st_mtime, file_stat.st_size, file_name))
+    cache_bytes = sum(file_size for _, file_size, _ in cache_entries)
+    for _, file_size, file_name in sorted(cache_entries):
+        if cache_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_directory, file_name))
+        except OSError:
+            continue
+        cache_bytes -= file_size
+
+def get_base_canvas(image_path: str, width: int, height: int, cache_directory: str = CANVAS_CACHE_DIRECTORY, max_bytes: int = CANVAS_CACHE_MAX_BYTES) -> (np.ndarray, bool):
+    # Prepared base canvas as raw RGBA, from the cache when possible; returns (canvas, cache hit)
+    if cache_directory is None:
+        return (prepare_base_canvas(image_path, width, height), False)
+    cache_path = os.path.join(cache_directory, canvas_cache_key(image_path, width, height) + '.npy')
+    
+    # A hit refreshes the entry's modification time, which is what eviction orders by
+    try:
+        base_rgba = np.load(cache_path)
+        os.utime(cache_path)
+        return (base_rgba, True)
+    except (OSError, ValueError):
+        pass
+    
+    # On a miss prepare the canvas, write it under a temporary name and move it into place so readers never see a partial file
+    base_rgba = prepare_base_canvas(image_path, width, height)
+    try:
+        os.makedirs(cache_directory, exist_ok=True)
+        temporary_path = f'{cache_path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as f:
+            np.save(f, base_rgba)
+        os.replace(temporary_path, cache_path)
+        evict_canvas_cache(cache_directory, max_bytes)
+    except OSError as e:
+        print(f'Could not cache the base canvas in {cache_directory}: {e}')
+    
+    return (base_rgba, False)
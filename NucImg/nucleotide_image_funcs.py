@@ -5,9 +5,14 @@ Created on Mon Apr  3 19:34:01 2023
 @author: ian.michael.bollinger@gmail.com
 """
 ### NUCLEOTIDE-IMAGE FUNCTIONS
+import io
 import os
+import re
 import sys
-import hashlib
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
 from tqdm import tqdm
 from apng import APNG
 from PIL import Image
@@ -20,21 +25,23 @@ working_directory = os.getcwd()
 if working_directory not in sys.path:
     sys.path.append(working_directory)
 
-from EncDec.encoding_decoding_funcs import tetra_bin_encode, ascii_bin_encode
-from CustFasta.custom_fasta_funcs import fasta_to_dataframe
+from EncDec.encoding_decoding_funcs import tetra_record_encode, tetrad_segments
+from CustFasta.custom_fasta_funcs import fasta_to_dataframe, md5_checksum
+from NucImg.canvas_cache_funcs import center_on_canvas
+from NucImg.png_chunk_funcs import (compress_rgba_frame,
+                                    write_png_file,
+                                    APNG_DISPOSE_OP_NONE,
+                                    APNG_DISPOSE_OP_BACKGROUND,
+                                    APNG_DISPOSE_OP_PREVIOUS,
+                                    APNG_BLEND_OP_SOURCE,
+                                    APNG_BLEND_OP_OVER)
 
 # Constants
 ORIG_IMG_EXT = '.png'
 APNG_EXT = '.apng'
-MD5_TAG = '<'
 OUTPUT_FOLDER_NAME = 'output'
 EXAMINATION_FOLDER_NAME = 'examination'
-
-def md5_checksum(file_path: str) -> str:
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-        md5 = hashlib.md5(file_data).hexdigest()
-    return md5
+TETRAD_SHIFTS = np.array([3, 2, 1, 0], dtype=np.uint8)
 
 def create_gif_from_images(images_dir: str, gif_path: str, duration: int):
     # Get a list of the image files in the directory
@@ -53,90 +60,279 @@ def create_gif_from_images(images_dir: str, gif_path: str, duration: int):
     # Save the image arrays as an animated GIF
     imageio.mimsave(gif_path, images, duration=duration)
 
-def get_rgba_values(image_path: str) -> (list, int):
-    # Open the image
-    img = Image.open(image_path)
+def get_rgba_array(image_path: str) -> (np.ndarray, int):
+    # Open the image and convert it to RGBA mode
+    img = Image.open(image_path).convert("RGBA")
     
-    # Convert the image to RGBA mode
-    img = img.convert("RGBA")
+    # View the image buffer as a read-only (H, W, 4) uint8 array, 4 bytes per pixel
+    rgba_array = np.asarray(img)
     
-    # Get the width and height of the image
-    width, height = img.size
-    
-    # Extract the RGBA values of the pixels
-    rgba_values = [img.getpixel((col, row)) for row in range(height) for col in range(width)]
+    return (rgba_array, img.width)
+
+def get_rgba_values(image_path: str) -> (list, int):
+    # List form of get_rgba_array, one RGBA tuple per pixel in row-major order
+    rgba_array, width = get_rgba_array(image_path)
+    rgba_values = [tuple(rgba) for rgba in rgba_array.reshape(-1, 4).tolist()]
     
     return (rgba_values, width)
 
-def process_tetrad_image(image_path: str, data: str, output_filename: str):
-    # Open the image and get its dimensions
-    img = Image.open(image_path)
-    width, height = img.size
-    # Convert the image to RGBA mode
-    img = img.convert("RGBA")
+def tetrad_block_width(tetrad_total: int) -> int:
+    # Width of the square-ish block holding tetrad_total tetrads
+    return int(tetrad_total ** 0.5) + 1
 
-    # Calculate the minimum width and height to fit the binary data
-    min_width = int((len(data) // 4) ** 0.5) + 1
-    min_height = int((len(data) // 4) ** 0.5) + 1
+def tetrad_block_layout(tetrad_total: int, width: int, height: int) -> (int, int, int, int):
+    # Calculate the minimum width (and row count) to fit the binary data
+    min_width = tetrad_block_width(tetrad_total)
+    min_rows = -(-tetrad_total // min_width)
 
     # Calculate the position to center the data in the image
     left = (width - min_width) // 2
-    top = (height - min_height) // 2
+    top = (height - min_width) // 2
+
+    return (top, left, min_rows, min_width)
+
+def embed_tetrad_array(base_rgba: np.ndarray, data) -> np.ndarray:
+    # Get the centered block that holds the data
+    height, width = base_rgba.shape[:2]
+    top, left, min_rows, min_width = tetrad_block_layout(tetrad_count(data), width, height)
+
+    # Place the payload nibbles in whole rows, piece by piece
+    padded_nibbles = np.zeros(min_rows * min_width, dtype=np.uint8)
+    for offset, nibbles in tetrad_segments(data):
+        padded_nibbles[offset:offset + len(nibbles)] = nibbles
+    flip_mask = (padded_nibbles.reshape(min_rows, min_width, 1) >> TETRAD_SHIFTS) & 1
+
+    # Flip every marked channel (RGBA = most to least significant bit) by 127 in a single pass over the block
+    encoded_rgba = base_rgba.copy()
+    block = encoded_rgba[top:top + min_rows, left:left + min_width]
+    flipped = np.where(block <= 127, block + 127, block - 127)
+    block[...] = np.where(flip_mask.astype(bool), flipped, block)
+
+    return encoded_rgba
+
+def process_tetrad_image(image_path, data, output_filename: str, compression: dict = None):
+    # Open the image as an (H, W, 4) RGBA array, or use an already prepared canvas array
+    base_rgba, width = (image_path, image_path.shape[1]) if isinstance(image_path, np.ndarray) else get_rgba_array(image_path)
+
+    # Embed the binary data and save the modified image to the specified output file with the chosen compression
+    encoded_rgba = embed_tetrad_array(base_rgba, data)
+    write_png_file(output_filename, width, encoded_rgba.shape[0], compress_rgba_frame(encoded_rgba, compression))
+
+# Base canvas of the job a worker is running, and every canvas this process can view, by name
+shared_base = {}
+shared_canvases = {}
+
+def attach_shared_canvas(canvas_name: str, shape: tuple) -> np.ndarray:
+    # View a published canvas without copying it, attaching to its shared memory once per process
+    if canvas_name not in shared_canvases:
+        shm = shared_memory.SharedMemory(name=canvas_name)
+        shared_canvases[canvas_name] = (shm, np.ndarray(shape, dtype=np.uint8, buffer=shm.buf))
+    
+    return shared_canvases[canvas_name][1]
 
-    # Get the pixel data of the image
-    pixel_data = img.load()
+def run_on_shared_canvas(function, canvas: tuple, args: tuple):
+    # Worker entry point: make the job's (name, shape) canvas the shared base, then run the job
+    if canvas is not None:
+        shared_base['rgba'] = attach_shared_canvas(*canvas)
+    
+    return function(*args)
+
+class SharedCanvasPool:
+    # Worker pool whose jobs run against base canvases published once in shared memory; one worker or fewer runs jobs in-process
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.executor = None
+        if workers > 1:
+            # Workers forked before the resource tracker starts would each run their own, which unlink canvases still in use when they exit
+            resource_tracker.ensure_running()
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.canvases = {}
+        self.canvas_users = {}
+        self.pending = {}
+        self.finished = []
+        self.local_canvas_count = 0
+
+    @property
+    def capacity(self) -> int:
+        # Jobs kept in flight, so memory stays proportional to the worker count
+        return 2 * max(self.workers, 1)
+
+    def publish(self, base_rgba: np.ndarray, canvas_key=None) -> tuple:
+        # Copy a canvas into shared memory and return its (name, shape); canvases with the same key are published once
+        if canvas_key is None or canvas_key not in self.canvases:
+            if self.executor is None:
+                canvas_name = f'local_canvas_{id(self)}_{self.local_canvas_count}'
+                self.local_canvas_count += 1
+                shared_canvases[canvas_name] = (None, base_rgba)
+            else:
+                shm = shared_memory.SharedMemory(create=True, size=max(base_rgba.nbytes, 1))
+                canvas_rgba = np.ndarray(base_rgba.shape, dtype=np.uint8, buffer=shm.buf)
+                canvas_rgba[...] = base_rgba
+                canvas_name = shm.name
+                shared_canvases[canvas_name] = (shm, canvas_rgba)
+            canvas_key = canvas_name if canvas_key is None else canvas_key
+            self.canvases[canvas_key] = (canvas_name, base_rgba.shape)
+        self.canvas_users[canvas_key] = self.canvas_users.get(canvas_key, 0) + 1
+        
+        return self.canvases[canvas_key]
+
+    def release(self, canvas: tuple):
+        # Drop one user of a published canvas, freeing its shared memory after the last one
+        canvas_key = next(key for key, published_canvas in self.canvases.items() if published_canvas == canvas)
+        self.canvas_users[canvas_key] -= 1
+        if self.canvas_users[canvas_key] == 0:
+            del self.canvases[canvas_key], self.canvas_users[canvas_key]
+            shm, _ = shared_canvases.pop(canvas[0])
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    def submit(self, tag, function, canvas: tuple, args: tuple):
+        # Queue function(*args) against a published canvas (or None); the result is returned by wait_any with its tag
+        if self.executor is None:
+            future = Future()
+            try:
+                future.set_result(run_on_shared_canvas(function, canvas, args))
+            except Exception as error:
+                future.set_exception(error)
+            self.finished.append((tag, future))
+        else:
+            self.pending[self.executor.submit(run_on_shared_canvas, function, canvas, args)] = tag
+
+    def wait_any(self) -> list:
+        # Wait for at least one job and return the (tag, future) pairs that have finished
+        if self.finished:
+            finished, self.finished = self.finished, []
+            return finished
+        if not self.pending:
+            return []
+        done, _ = wait(self.pending, return_when=FIRST_COMPLETED)
+        
+        return [(self.pending.pop(future), future) for future in done]
+
+    def imap_unordered(self, jobs):
+        # Run (tag, function, canvas, args) jobs with a bounded number in flight, yielding (tag, result) as they finish
+        for tag, function, canvas, args in jobs:
+            self.submit(tag, function, canvas, args)
+            if len(self.pending) + len(self.finished) >= self.capacity:
+                for finished_tag, future in self.wait_any():
+                    yield (finished_tag, future.result())
+        while self.pending or self.finished:
+            for finished_tag, future in self.wait_any():
+                yield (finished_tag, future.result())
+
+    def close(self):
+        # Stop the workers and free every canvas still published
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+        for canvas_name, _ in self.canvases.values():
+            shm, _ = shared_canvases.pop(canvas_name)
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+        self.canvases.clear()
+        self.canvas_users.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def changed_frame_box(base_rgba: np.ndarray, encoded_rgba: np.ndarray, data) -> (int, int, int, int):
+    # Bounding (x, y, width, height) box of the pixels the data changed, searched within its block only
+    height, width = base_rgba.shape[:2]
+    top, left, min_rows, min_width = tetrad_block_layout(tetrad_count(data), width, height)
+    block_slice = (slice(top, top + min_rows), slice(left, left + min_width))
+    changed_pixels = (base_rgba[block_slice] != encoded_rgba[block_slice]).any(axis=2)
+    changed_rows = np.flatnonzero(changed_pixels.any(axis=1))
+    changed_cols = np.flatnonzero(changed_pixels.any(axis=0))
+    if changed_rows.size == 0:
+        return (0, 0, 1, 1)
+    
+    return (left + changed_cols[0], top + changed_rows[0],
+            changed_cols[-1] - changed_cols[0] + 1, changed_rows[-1] - changed_rows[0] + 1)
+
+def encode_frame_worker(frame_index: int, data, output_filename: str, delta: bool = False, compression: dict = None) -> (int, str, bytes, tuple, float):
+    # Embed one chromosome into the shared base canvas, compress it once and save it, timing the frame
+    start_time = time.perf_counter()
+    base_rgba = shared_base['rgba']
+    encoded_rgba = embed_tetrad_array(base_rgba, data)
+    height, width = encoded_rgba.shape[:2]
+    
+    # Delta frames keep only the changed box; the PNG records its offset for standalone decoding
+    if delta:
+        x_offset, y_offset, box_width, box_height = frame_box = changed_frame_box(base_rgba, encoded_rgba, data)
+        compressed_frame = compress_rgba_frame(encoded_rgba[y_offset:y_offset + box_height, x_offset:x_offset + box_width], compression)
+        write_png_file(output_filename, box_width, box_height, compressed_frame, offset=(x_offset, y_offset))
+    else:
+        frame_box = (0, 0, width, height)
+        compressed_frame = compress_rgba_frame(encoded_rgba, compression)
+        write_png_file(output_filename, width, height, compressed_frame)
+    
+    return (frame_index, output_filename, compressed_frame, frame_box, time.perf_counter() - start_time)
 
-    # Iterate through the binary data and modify the image accordingly
-    for i, binary_group in enumerate([data[i:i+4] for i in range(0, len(data), 4)]):
-        row, col = divmod(i, min_width)
-        row += top
-        col += left
-        rgba = list(pixel_data[col, row])
-        for j, bit in enumerate(binary_group):
-            if int(bit):
-                rgba[j] = rgba[j] + 127 if rgba[j] <= 127 else rgba[j] - 127
-        pixel_data[col, row] = tuple(rgba)
+def place_frame_rgba(frame_rgba: np.ndarray, offset: tuple, base_rgba: np.ndarray) -> np.ndarray:
+    # Place a cropped (delta) frame on a copy of the base canvas at its (x, y) offset
+    if frame_rgba.shape == base_rgba.shape:
+        return frame_rgba
+    
+    x_offset, y_offset = offset
+    frame_height, frame_width = frame_rgba.shape[:2]
+    canvas_rgba = base_rgba.copy()
+    canvas_rgba[y_offset:y_offset + frame_height, x_offset:x_offset + frame_width] = frame_rgba
+    
+    return canvas_rgba
+
+def map_with_shared_base(function, base_rgba: np.ndarray, jobs, workers: int):
+    # Run function(*job) for every job with base_rgba shared by all workers, yielding results as they finish
+    with SharedCanvasPool(workers) as pool:
+        canvas = pool.publish(base_rgba)
+        for _, result in pool.imap_unordered((None, function, canvas, job) for job in jobs):
+            yield result
+
+def parallel_tetrad_encode(base_rgba: np.ndarray, frame_jobs, workers: int):
+    # Encode (frame_index, data, output_filename, delta, compression) jobs, yielding (frame_index, output_filename, compressed_frame, frame_box, seconds) as each frame finishes
+    return map_with_shared_base(encode_frame_worker, base_rgba, frame_jobs, workers)
+
+def in_frame_order(frame_results):
+    # Re-order results that start with a frame index, holding only the frames that finished early
+    next_index = 0
+    finished_frames = {}
+    for frame_result in frame_results:
+        finished_frames[frame_result[0]] = frame_result
+        while next_index in finished_frames:
+            yield finished_frames.pop(next_index)
+            next_index += 1
+
+def tetrad_count(data) -> int:
+    # Number of pixels needed for a TetradPayload, '0'/'1' string or nibble array
+    if isinstance(data, str):
+        return len(data) // 4
+    
+    return len(data)
 
-    # Save the modified image to the specified output file
-    img.save(output_filename)
+def get_canvas_size(tetrad_counts: list) -> (int, int):
+    # Size the square canvas to fit the largest tetrad count
+    max_side = max((tetrad_block_width(count) for count in tetrad_counts), default=0)
+    
+    return (max_side, max_side)
 
 def get_largest_image_size(data_list: list) -> (int, int):
-    # Initialize the maximum width and height
-    max_width, max_height = 0, 0
-    
-    # Loop through the data_list to find the largest dimensions
-    for data in data_list:
-        width = int((len(data) // 4) ** 0.5) + 1
-        height = int((len(data) // 4) ** 0.5) + 1
-        max_width = max(max_width, width)
-        max_height = max(max_height, height)
-        
-    return(max_width, max_height)
+    # Find the largest dimensions needed across all the data in data_list
+    return get_canvas_size([tetrad_count(data) for data in data_list])
 
 def resize_image(input_image_path: str, output_width: int, output_height: int) -> Image:
-    # Open the input image
-    img = Image.open(input_image_path)
-    
-    # Get the dimensions of the input image
-    img_width, img_height = img.size
-
-    # Create a new white image with the desired dimensions
-    new_image = Image.new('RGBA', (output_width, output_height), (255, 255, 255, 255))
+    # Open the input image and center it on a white image with the desired dimensions
+    return center_on_canvas(Image.open(input_image_path), output_width, output_height)
 
-    # Calculate the position to center the original image
-    left = (output_width - img_width) // 2
-    top = (output_height - img_height) // 2
-    right = (output_width + img_width) // 2
-    bottom = (output_height + img_height) // 2
-
-    # Paste the original image onto the white background
-    new_image.paste(img, (left, top, right, bottom))
-    
-    return new_image
+def natural_sort_key(file_name: str) -> list:
+    # Sort key that orders embedded numbers numerically (chrom_2 before chrom_10)
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', file_name)]
 
 def png_dir_apng_gen(input_directory: str, output_apng_path: str):  
-    # Read all PNG files and sort them by name
-    png_files = sorted([f for f in os.listdir(input_directory) if f.endswith('.png')])
+    # Read all PNG files and sort them by name, in chromosome order
+    png_files = sorted([f for f in os.listdir(input_directory) if f.endswith('.png')], key=natural_sort_key)
     
     # Create an APNG object
     apng = APNG()
@@ -155,15 +351,42 @@ def optimize_png(image, output_png_path: str):
     # Save the optimized image
     optimized_image.save(output_png_path, format="PNG")
 
-def split_apng(apng_path: str, output_folder: str):
+def split_apng(apng_path: str, output_folder: str, compression: dict = None) -> list:
     # Open the APNG file
     apng = APNG.open(apng_path)
-
-    # Loop through the frames and save them as PNGs
+    
+    # Loop through the frames, composite each onto the canvas and save the full frame as a PNG
+    default_png = apng.frames[0][0]
+    canvas_rgba = np.zeros((default_png.height, default_png.width, 4), dtype=np.uint8)
+    output_paths = []
     for frame_number, (png, control) in enumerate(apng.frames):
-        # Save the frame as a PNG file
+        frame_rgba = np.asarray(Image.open(io.BytesIO(png.to_bytes())).convert("RGBA"))
+        x_offset, y_offset = (control.x_offset, control.y_offset) if control else (0, 0)
+        dispose_op = control.depose_op if control else APNG_DISPOSE_OP_NONE
+        blend_op = control.blend_op if control else APNG_BLEND_OP_SOURCE
+        frame_height, frame_width = frame_rgba.shape[:2]
+        region = (slice(y_offset, y_offset + frame_height), slice(x_offset, x_offset + frame_width))
+        
+        # Remember what a dispose-to-previous frame has to restore
+        previous_region = canvas_rgba[region].copy()
+        if blend_op == APNG_BLEND_OP_OVER:
+            canvas_region = Image.fromarray(np.ascontiguousarray(canvas_rgba[region]), 'RGBA')
+            canvas_rgba[region] = np.asarray(Image.alpha_composite(canvas_region, Image.fromarray(frame_rgba, 'RGBA')))
+        else:
+            canvas_rgba[region] = frame_rgba
+        
+        # Save the frame as a PNG file, in the row format QC can stream
         output_path = os.path.join(output_folder, f'chrom_{frame_number:03d}.png')
-        png.save(output_path)
+        write_png_file(output_path, canvas_rgba.shape[1], canvas_rgba.shape[0], compress_rgba_frame(canvas_rgba, compression))
+        output_paths.append(output_path)
+        
+        if dispose_op == APNG_DISPOSE_OP_PREVIOUS:
+            canvas_rgba[region] = previous_region
+        elif dispose_op == APNG_DISPOSE_OP_BACKGROUND:
+            canvas_rgba[region] = 0
+    
+    # Paths of the frames written, base image first
+    return output_paths
 
 def create_output_directory(base_path: str, folder_name: str) -> str:
     # Join the base path and folder name to create the new directory path
@@ -215,11 +438,7 @@ if __name__ == '__main__':
     for idx, row in tqdm(fasta_df.iterrows(), total=fasta_df.shape[0], desc='Processing Sequences', ncols=100):
         description = row['Description']
         sequence = row['Sequence']
-        sequence_binary, nucleotide_type, encoding_key = tetra_bin_encode(sequence)
-        md5_desc_type_enc = f'{description}<{generated_md5_checksum}<{nucleotide_type}<{encoding_key}<'
-        md5_desc_type_enc_binary = ascii_bin_encode(md5_desc_type_enc)
-        data_binary = md5_desc_type_enc_binary + sequence_binary
-        binary_data_list.append(data_binary)
+        binary_data_list.append(tetra_record_encode(description, sequence, generated_md5_checksum))
     
     # Determine the largest image needed for encoding
     max_width, max_height = get_largest_image_size(binary_data_list)
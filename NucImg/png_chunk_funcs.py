@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 10:12:40 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
+### PNG/APNG CHUNK FUNCTIONS
+import io
+import os
+import json
+import zlib
+import struct
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+# Constants
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+RGBA_COLOR_TYPE = 6
+MAX_DATA_CHUNK = 1 << 20
+APNG_DELAY_NUM = 500
+APNG_DELAY_DEN = 1000
+APNG_DISPOSE_OP_NONE = 0
+APNG_DISPOSE_OP_BACKGROUND = 1
+APNG_DISPOSE_OP_PREVIOUS = 2
+APNG_BLEND_OP_SOURCE = 0
+APNG_BLEND_OP_OVER = 1
+FRAME_INDEX_CHUNK = b'nbIx'
+FRAME_INDEX_VERSION = 1
+
+# PNG row filter types and zlib strategies by name
+PNG_FILTERS = {'none': 0, 'sub': 1, 'up': 2, 'average': 3, 'paeth': 4, 'adaptive': None}
+ZLIB_STRATEGIES = {'default': zlib.Z_DEFAULT_STRATEGY, 'filtered': zlib.Z_FILTERED, 'huffman': zlib.Z_HUFFMAN_ONLY,
+                   'rle': zlib.Z_RLE, 'fixed': zlib.Z_FIXED}
+
+# Compression presets; 'default' matches the original zlib.compress output
+PNG_COMPRESSION_PRESETS = {'default': {'level': 6, 'filter': 'none', 'strategy': 'default', 'threads': 1, 'block_size': 1 << 22},
+                           'fast': {'level': 1, 'filter': 'sub', 'strategy': 'rle', 'threads': 1, 'block_size': 1 << 22},
+                           'small': {'level': 9, 'filter': 'sub', 'strategy': 'filtered', 'threads': 1, 'block_size': 1 << 22}}
+
+def png_chunk(chunk_type: bytes, chunk_data: bytes) -> bytes:
+    # Length, type, data and the CRC over type + data
+    chunk_crc = zlib.crc32(chunk_data, zlib.crc32(chunk_type))
+    return struct.pack('>I', len(chunk_data)) + chunk_type + chunk_data + struct.pack('>I', chunk_crc)
+
+def ihdr_chunk(width: int, height: int) -> bytes:
+    # 8-bit RGBA, deflate, adaptive filtering, no interlace
+    return png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, RGBA_COLOR_TYPE, 0, 0, 0))
+
+def offs_chunk(x_offset: int, y_offset: int) -> bytes:
+    # Image offset in pixels, used to place a cropped frame back on its canvas
+    return png_chunk(b'oFFs', struct.pack('>iiB', x_offset, y_offset, 0))
+
+def iter_png_chunks(f):
+    # Yield (chunk type, chunk data) from a PNG file object, checking the signature and stopping at IEND
+    if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            return
+        chunk_length, chunk_type = struct.unpack('>I4s', chunk_header)
+        chunk_data = f.read(chunk_length)
+        f.read(4)
+        yield (chunk_type, chunk_data)
+        if chunk_type == b'IEND':
+            return
+
+def png_compression_settings(preset: str = 'default', **overrides) -> dict:
+    # Start from a named preset and override any of level, filter, strategy, threads and block_size (None keeps the preset value)
+    compression = dict(PNG_COMPRESSION_PRESETS[preset])
+    compression.update({setting: value for setting, value in overrides.items() if value is not None})
+    if compression['filter'] not in PNG_FILTERS:
+        raise ValueError(f"Unknown PNG filter '{compression['filter']}'")
+    if compression['strategy'] not in ZLIB_STRATEGIES:
+        raise ValueError(f"Unknown zlib strategy '{compression['strategy']}'")
+    
+    return compression
+
+def filter_scanlines(rgba: np.ndarray, png_filter: str) -> np.ndarray:
+    # Apply a PNG row filter to every row at once, returning (H, 1 + W * 4) scanlines with the filter type byte first
+    # Filters only read the unfiltered neighbours (left a, up b, upper-left c), so all rows can be filtered together
+    height, width = rgba.shape[:2]
+    raw = rgba.reshape(height, width * 4)
+    scanlines = np.empty((height, 1 + width * 4), dtype=np.uint8)
+    filter_types = [PNG_FILTERS[png_filter]] if png_filter != 'adaptive' else [0, 1, 2, 3, 4]
+    if filter_types == [0]:
+        scanlines[:, 0] = 0
+        scanlines[:, 1:] = raw
+        return scanlines
+    
+    left = np.zeros_like(raw)
+    left[:, 4:] = raw[:, :-4]
+    up = np.zeros_like(raw)
+    up[1:] = raw[:-1]
+    upper_left = np.zeros_like(raw)
+    upper_left[1:, 4:] = raw[:-1, :-4]
+    
+    # Score candidate filters per row by the sum of bytes as signed values, the usual minimum-sum heuristic
+    best_score = None
+    for filter_type in filter_types:
+        if filter_type == 0:
+            filtered = raw
+        elif filter_type == 1:
+            filtered = raw - left
+        elif filter_type == 2:
+            filtered = raw - up
+        elif filter_type == 3:
+            filtered = raw - ((left.astype(np.uint16) + up) >> 1).astype(np.uint8)
+        else:
+            estimate = left.astype(np.int16) + up - upper_left
+            left_distance = np.abs(estimate - left)
+            up_distance = np.abs(estimate - up)
+            upper_left_distance = np.abs(estimate - upper_left)
+            predictor = np.where((left_distance <= up_distance) & (left_distance <= upper_left_distance), left,
+                                 np.where(up_distance <= upper_left_distance, up, upper_left))
+            filtered = raw - predictor
+        if len(filter_types) == 1:
+            scanlines[:, 0] = filter_type
+            scanlines[:, 1:] = filtered
+            return scanlines
+        score = np.abs(filtered.view(np.int8).astype(np.int32)).sum(axis=1)
+        better_rows = np.ones(height, dtype=bool) if best_score is None else score < best_score
+        best_score = score if best_score is None else np.minimum(score, best_score)
+        scanlines[better_rows, 0] = filter_type
+        scanlines[better_rows, 1:] = filtered[better_rows]
+    
+    return scanlines
+
+def deflate_block(data: memoryview, level: int, strategy: int, last_block: bool) -> bytes:
+    # Raw deflate of one block; blocks before the last end on a byte boundary so they can be concatenated
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zlib.DEF_MEM_LEVEL, strategy)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last_block else zlib.Z_FULL_FLUSH)
+
+def compress_scanlines(scanline_bytes: bytes, compression: dict) -> bytes:
+    # zlib stream for the IDAT data; large frames are split into blocks deflated on several threads
+    level = compression['level']
+    strategy = ZLIB_STRATEGIES[compression['strategy']]
+    block_size = compression['block_size']
+    if compression['threads'] <= 1 or len(scanline_bytes) <= block_size:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 15, zlib.DEF_MEM_LEVEL, strategy)
+        return compressor.compress(scanline_bytes) + compressor.flush()
+    
+    # zlib releases the GIL while deflating, so threads compress blocks in parallel; the zlib header and Adler-32 wrap them
+    data = memoryview(scanline_bytes)
+    block_starts = range(0, len(data), block_size)
+    with ThreadPoolExecutor(max_workers=compression['threads']) as executor:
+        blocks = executor.map(lambda start: deflate_block(data[start:start + block_size], level, strategy, start + block_size >= len(data)), block_starts)
+        deflate_data = b''.join(blocks)
+    
+    return b'\x78\x9c' + deflate_data + struct.pack('>I', zlib.adler32(scanline_bytes))
+
+def open_png_source(png_source):
+    # PNG paths and in-memory PNG bytes are opened as binary file objects; open file objects are used as they are
+    if isinstance(png_source, (bytes, bytearray)):
+        return io.BytesIO(png_source)
+    if isinstance(png_source, str):
+        return open(png_source, 'rb')
+    
+    return png_source
+
+def read_png_header(png_source) -> dict:
+    # Size, pixel format and oFFs offset of a PNG, read from the chunks before the image data
+    png_header = {'offset': (0, 0)}
+    f = open_png_source(png_source)
+    try:
+        for chunk_type, chunk_data in iter_png_chunks(f):
+            if chunk_type == b'IHDR':
+                (png_header['width'], png_header['height'], png_header['bit_depth'], png_header['color_type'],
+                 _, _, png_header['interlace']) = struct.unpack('>IIBBBBB', chunk_data)
+            elif chunk_type == b'oFFs':
+                png_header['offset'] = struct.unpack('>iiB', chunk_data)[:2]
+            elif chunk_type in (b'IDAT', b'IEND'):
+                break
+    finally:
+        if f is not png_source:
+            f.close()
+    
+    return png_header
+
+def png_rows_supported(png_header: dict) -> bool:
+    # Row streaming handles the frames this package writes: 8-bit RGBA without interlacing
+    return png_header.get('bit_depth') == 8 and png_header.get('color_type') == RGBA_COLOR_TYPE and png_header.get('interlace') == 0
+
+def unfilter_row(filter_type: int, row: np.ndarray, previous_row: np.ndarray, bytes_per_pixel: int = 4) -> np.ndarray:
+    # Undo a PNG row filter using only the previous row; None, Sub and Up are vectorized
+    if filter_type == 0:
+        return row
+    if filter_type == 1:
+        return np.cumsum(row.reshape(-1, bytes_per_pixel), axis=0, dtype=np.uint8).reshape(-1)
+    if filter_type == 2:
+        return row + previous_row
+    if filter_type not in (3, 4):
+        raise ValueError(f'Unknown PNG filter type {filter_type}')
+    
+    # Average and Paeth depend on the already unfiltered left byte, so they run byte by byte over int lists
+    raw = row.tolist()
+    up = previous_row.tolist()
+    if filter_type == 3:
+        for i in range(bytes_per_pixel):
+            raw[i] = (raw[i] + (up[i] >> 1)) & 0xFF
+        for i in range(bytes_per_pixel, len(raw)):
+            raw[i] = (raw[i] + ((raw[i - bytes_per_pixel] + up[i]) >> 1)) & 0xFF
+    else:
+        # The first pixel has no left or upper-left neighbour, so Paeth predicts it from the byte above
+        for i in range(bytes_per_pixel):
+            raw[i] = (raw[i] + up[i]) & 0xFF
+        for i in range(bytes_per_pixel, len(raw)):
+            left, upper, upper_left = raw[i - bytes_per_pixel], up[i], up[i - bytes_per_pixel]
+            left_distance, up_distance, upper_left_distance = abs(upper - upper_left), abs(left - upper_left), abs(left + upper - 2 * upper_left)
+            if left_distance <= up_distance and left_distance <= upper_left_distance:
+                raw[i] = (raw[i] + left) & 0xFF
+            elif up_distance <= upper_left_distance:
+                raw[i] = (raw[i] + upper) & 0xFF
+            else:
+                raw[i] = (raw[i] + upper_left) & 0xFF
+    
+    return np.array(raw, dtype=np.uint8)
+
+def iter_png_rows(png_source, rows_per_inflate: int = 64):
+    # Yield (row index, RGBA row of width * 4 bytes) while inflating the image data incrementally
+    # At most rows_per_inflate rows are decompressed at a time, so memory stays bounded by the row width, not the frame size
+    f = open_png_source(png_source)
+    try:
+        decompressor = zlib.decompressobj()
+        pending = bytearray()
+        row_index = 0
+        for chunk_type, chunk_data in iter_png_chunks(f):
+            if chunk_type == b'IHDR':
+                width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk_data)
+                if not png_rows_supported({'bit_depth': bit_depth, 'color_type': color_type, 'interlace': interlace}):
+                    raise ValueError('Row streaming needs an 8-bit RGBA, non-interlaced PNG')
+                stride = 1 + width * 4
+                previous_row = np.zeros(width * 4, dtype=np.uint8)
+            elif chunk_type == b'IDAT':
+                compressed_data = chunk_data
+                while compressed_data:
+                    pending += decompressor.decompress(compressed_data, stride * rows_per_inflate)
+                    compressed_data = decompressor.unconsumed_tail
+                    rows_ready = len(pending) // stride
+                    filtered_rows = np.frombuffer(bytes(pending[:rows_ready * stride]), dtype=np.uint8).reshape(rows_ready, stride)
+                    del pending[:rows_ready * stride]
+                    for filtered_row in filtered_rows:
+                        previous_row = unfilter_row(filtered_row[0], filtered_row[1:], previous_row)
+                        yield (row_index, previous_row)
+                        row_index += 1
+            elif chunk_type == b'IEND':
+                break
+        if row_index != height:
+            raise ValueError(f'PNG image data ended after {row_index} of {height} rows')
+    finally:
+        if f is not png_source:
+            f.close()
+
+def compress_rgba_frame(rgba: np.ndarray, compression: dict = None) -> bytes:
+    # Filter every row and deflate the scanlines into an IDAT stream; by default filter type 0 (None) and zlib level 6
+    compression = compression or PNG_COMPRESSION_PRESETS['default']
+    scanlines = filter_scanlines(rgba, compression['filter'])
+
+    return compress_scanlines(scanlines.tobytes(), compression)
+
+def split_data_chunks(compressed_data: bytes):
+    # Split a deflate stream into chunk-sized pieces
+    for offset in range(0, max(len(compressed_data), 1), MAX_DATA_CHUNK):
+        yield compressed_data[offset:offset + MAX_DATA_CHUNK]
+
+def write_png_file(output_filename: str, width: int, height: int, compressed_data: bytes, offset: tuple = None):
+    # Write an already-compressed RGBA frame as a standalone PNG, with an oFFs chunk for cropped frames
+    with open(output_filename, 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(ihdr_chunk(width, height))
+        if offset is not None:
+            f.write(offs_chunk(*offset))
+        for chunk_data in split_data_chunks(compressed_data):
+            f.write(png_chunk(b'IDAT', chunk_data))
+        f.write(png_chunk(b'IEND', b''))
+
+class APNGStreamWriter:
+    # Write an APNG one compressed frame at a time; the frame count in acTL is patched on close
+    def __init__(self, output_apng_path: str, width: int, height: int, delay_num: int = APNG_DELAY_NUM, delay_den: int = APNG_DELAY_DEN):
+        self.width = width
+        self.height = height
+        self.delay_num = delay_num
+        self.delay_den = delay_den
+        self.frame_count = 0
+        self.sequence_number = 0
+        self.frame_index = []
+
+        # Header, then a placeholder acTL (frame count, loop forever) to patch later
+        self.file = open(output_apng_path, 'wb')
+        self.file.write(PNG_SIGNATURE)
+        self.file.write(ihdr_chunk(width, height))
+        self.actl_offset = self.file.tell()
+        self.file.write(png_chunk(b'acTL', struct.pack('>II', 0, 0)))
+
+    def next_sequence_number(self) -> int:
+        # fcTL and fdAT chunks share a single sequence counter
+        sequence_number = self.sequence_number
+        self.sequence_number += 1
+        return sequence_number
+
+    def append(self, compressed_data: bytes, frame_box: tuple = None, dispose_op: int = APNG_DISPOSE_OP_NONE, blend_op: int = APNG_BLEND_OP_SOURCE, frame_info: dict = None):
+        # Frame control for the (x, y, width, height) region, the full canvas by default
+        frame_offset = self.file.tell()
+        x_offset, y_offset, frame_width, frame_height = frame_box or (0, 0, self.width, self.height)
+        fctl_data = struct.pack('>IIIIIHHBB', self.next_sequence_number(), frame_width, frame_height,
+                                x_offset, y_offset, self.delay_num, self.delay_den, dispose_op, blend_op)
+        self.file.write(png_chunk(b'fcTL', fctl_data))
+
+        # The first frame doubles as the default image (IDAT); later frames use fdAT
+        for chunk_data in split_data_chunks(compressed_data):
+            if self.frame_count == 0:
+                self.file.write(png_chunk(b'IDAT', chunk_data))
+            else:
+                self.file.write(png_chunk(b'fdAT', struct.pack('>I', self.next_sequence_number()) + chunk_data))
+        
+        # Index the byte span of the frame (fcTL through its last data chunk) with its metadata
+        index_entry = {'frame': self.frame_count, 'offset': frame_offset, 'length': self.file.tell() - frame_offset}
+        index_entry.update(frame_info or {})
+        self.frame_index.append(index_entry)
+        self.frame_count += 1
+
+    def append_rgba(self, rgba: np.ndarray, compression: dict = None):
+        # Compress and append an (H, W, 4) frame
+        self.append(compress_rgba_frame(rgba, compression))
+
+    def close(self):
+        # Finish the file with the frame index chunk and record the final frame count in acTL
+        if self.file.closed:
+            return
+        self.file.write(frame_index_chunk(self.width, self.height, self.frame_index))
+        self.file.write(png_chunk(b'IEND', b''))
+        self.file.seek(self.actl_offset)
+        self.file.write(png_chunk(b'acTL', struct.pack('>II', self.frame_count, 0)))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def frame_index_chunk(width: int, height: int, frame_index: list) -> bytes:
+    # Private ancillary chunk: the JSON frame index followed by its byte length, so it can be found from the end of the file
+    index_json = json.dumps({'version': FRAME_INDEX_VERSION, 'width': width, 'height': height, 'frames': frame_index}).encode('utf-8')
+    return png_chunk(FRAME_INDEX_CHUNK, index_json + struct.pack('>I', len(index_json)))
+
+def read_apng_index(apng_path: str) -> dict:
+    # Read the frame index that sits just before the 12-byte IEND chunk, touching only the file tail
+    # Files without a valid index (older or third-party APNGs) give None, so callers can fall back to splitting the frames
+    file_size = os.path.getsize(apng_path)
+    if file_size < len(PNG_SIGNATURE) + 12 + 4 + 4 + 8:
+        return None
+    with open(apng_path, 'rb') as f:
+        f.seek(-(12 + 4 + 4), os.SEEK_END)
+        index_length = struct.unpack('>I', f.read(4))[0]
+        if index_length + 12 + 4 + 4 + 8 > file_size - len(PNG_SIGNATURE):
+            return None
+        f.seek(-(12 + 4 + 4 + index_length + 8), os.SEEK_END)
+        chunk_length, chunk_type = struct.unpack('>I4s', f.read(8))
+        if chunk_type != FRAME_INDEX_CHUNK or chunk_length != index_length + 4:
+            return None
+        
+        try:
+            return json.loads(f.read(index_length).decode('utf-8'))
+        except ValueError:
+            return None
+
+def read_apng_frame(f, index_entry: dict) -> (tuple, bytes):
+    # Read one indexed frame's chunks and rebuild it as a standalone PNG; returns ((x, y, width, height), png bytes)
+    f.seek(index_entry['offset'])
+    frame_chunks = f.read(index_entry['length'])
+    frame_box = None
+    idat_chunks = []
+    position = 0
+    while position < len(frame_chunks):
+        chunk_length, chunk_type = struct.unpack('>I4s', frame_chunks[position:position + 8])
+        chunk_data = frame_chunks[position + 8:position + 8 + chunk_length]
+        if chunk_type == b'fcTL':
+            frame_width, frame_height, x_offset, y_offset = struct.unpack('>IIII', chunk_data[4:20])
+            frame_box = (x_offset, y_offset, frame_width, frame_height)
+        elif chunk_type == b'IDAT':
+            idat_chunks.append(png_chunk(b'IDAT', chunk_data))
+        elif chunk_type == b'fdAT':
+            idat_chunks.append(png_chunk(b'IDAT', chunk_data[4:]))
+        position += 12 + chunk_length
+    
+    png_bytes = PNG_SIGNATURE + ihdr_chunk(frame_box[2], frame_box[3]) + b''.join(idat_chunks) + png_chunk(b'IEND', b'')
+    
+    return (frame_box, png_bytes)
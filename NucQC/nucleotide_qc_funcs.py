@@ -5,10 +5,11 @@ Created on Mon Apr  3 19:49:06 2023
 @author: ian.michael.bollinger@gmail.com
 """
 ### QC FUNCTIONS
-import hashlib
-import pandas as pd
+import io
+import numpy as np
 import sys
 import os
+import tempfile
 from PIL import Image
 from tqdm import tqdm
 from concurrent.futures import ThreadPoolExecutor
@@ -20,144 +21,423 @@ working_directory = os.getcwd()
 if working_directory not in sys.path:
     sys.path.append(working_directory)
 
-from EncDec.encoding_decoding_funcs import (tetra_bin_encode,
-                                            ascii_bin_encode,
-                                            ascii_bin_decode,
-                                            tetra_bin_decode)
+from EncDec.encoding_decoding_funcs import (tetra_record_encode,
+                                            tetra_nibble_decode,
+                                            bytes_to_nibbles,
+                                            TetradPayload,
+                                            frame_payload_tetrads,
+                                            parse_tiled_frame,
+                                            reassemble_tiled_records)
 from NucImg.nucleotide_image_funcs import (get_largest_image_size,
                                            resize_image,
                                            process_tetrad_image,
                                            png_dir_apng_gen,
                                            split_apng,
-                                           get_rgba_values)
+                                           get_rgba_array,
+                                           place_frame_rgba,
+                                           tetrad_block_width,
+                                           map_with_shared_base,
+                                           in_frame_order,
+                                           shared_base)
+from NucImg.png_chunk_funcs import (read_apng_index,
+                                    read_apng_frame,
+                                    read_png_header,
+                                    png_rows_supported,
+                                    iter_png_rows)
 from CustFasta.custom_fasta_funcs import (fasta_to_dataframe,
-                                          reconstruct_fna_from_df)
-
-md5_checksum_split = ascii_bin_encode('<')
+                                          write_fasta_records,
+                                          md5_checksum,
+                                          fasta_line_width,
+                                          fasta_record_id,
+                                          FASTA_LINE_WIDTH)
 
 def find_file_types(directory: str, file_type: str) -> list:
     # List all files in the directory
     all_files = os.listdir(directory)
     
     # Filter the files with 'chrom' in their name and the file_type extension
-    chrom_file_types = [f for f in all_files if f.endswith(file_type)]
+    chrom_file_types = sorted(f for f in all_files if f.endswith(file_type))
     
     return chrom_file_types
 
-def md5_checksum(file_path: str) -> str:
-    with open(file_path, 'rb') as f:
-        file_data = f.read()
-        md5 = hashlib.md5(file_data).hexdigest()
-    return md5
+def as_rgba_array(image, shape: tuple = None) -> np.ndarray:
+    # Load an image path (or in-memory PNG bytes) as an (H, W, 4) RGBA array
+    if isinstance(image, str):
+        rgba_array, _ = get_rgba_array(image)
+        return rgba_array
+    if isinstance(image, (bytes, bytearray)):
+        return np.asarray(Image.open(io.BytesIO(image)).convert("RGBA"))
+    
+    # Arrays (or flat lists of RGBA tuples) are reshaped to the given image shape
+    rgba_array = np.asarray(image, dtype=np.uint8)
+    if shape is not None:
+        rgba_array = rgba_array.reshape(shape)
+    
+    return rgba_array
 
-def first_qc_check(input_fasta_file: str, first_check_index: int, output_encoded_image_path: str):
-    generated_md5_checksum = md5_checksum(input_fasta_file)
-    original_rgba_values, width = get_rgba_values(original_image_copy)
-    encoded_rgba_values, _ = get_rgba_values(output_encoded_image_path)
+def stream_frame_nibbles(original_rgba: np.ndarray, encoded_png, offset: tuple = None) -> np.ndarray:
+    # Decode a PNG frame row by row against the base canvas, never holding the whole decoded frame
+    # Cropped (delta) frames are compared at their oFFs offset, or at the given (x, y) offset for APNG frames
+    png_header = read_png_header(encoded_png)
+    x_offset, y_offset = offset if offset is not None else png_header['offset']
+    frame_width = png_header['width']
+    canvas_width = original_rgba.shape[1]
+    
+    # Keep one nibble per pixel for every row from the first changed row on
+    block_rows = None
+    last_changed_row = -1
+    left = canvas_width
+    for row_index, encoded_row in iter_png_rows(encoded_png):
+        original_row = original_rgba[y_offset + row_index, x_offset:x_offset + frame_width].reshape(-1)
+        difference_bits = original_row != encoded_row
+        if block_rows is None:
+            if not difference_bits.any():
+                continue
+            top = row_index
+            block_rows = np.zeros((png_header['height'] - top, frame_width), dtype=np.uint8)
+        row_nibbles = bytes_to_nibbles(np.packbits(difference_bits))[:frame_width]
+        changed_cols = np.flatnonzero(row_nibbles)
+        if changed_cols.size:
+            block_rows[row_index - top] = row_nibbles
+            last_changed_row = row_index - top
+            left = min(left, x_offset + changed_cols[0])
+    if block_rows is None:
+        return None
+    block_rows = block_rows[:last_changed_row + 1]
+    
+    # The block is centered, so it starts at the left column and spans the canvas width less both margins, or one less
+    max_width = canvas_width - 2 * left
+    block_left = left - x_offset
+    block_nibbles = block_rows[:, block_left:block_left + max_width]
+    if block_nibbles.shape[1] < max_width:
+        block_nibbles = np.pad(block_nibbles, ((0, 0), (0, max_width - block_nibbles.shape[1])))
+    
+    return block_payload_nibbles(block_nibbles)
 
-    first_check_binary_data = ''.join(
-        ''.join('0' if orig == enc else '1' for orig, enc in zip(orig_rgba, enc_rgba))
-        for orig_rgba, enc_rgba in zip(original_rgba_values, encoded_rgba_values))
+def block_payload_nibbles(block_nibbles: np.ndarray) -> np.ndarray:
+    # Flatten the (rows, widest possible width) block nibbles into the frame's data
+    # The block is one of two widths; the one whose headers give a payload of exactly that block width is the right one
+    block_rows, max_width = block_nibbles.shape
+    for min_width in (max_width, max_width - 1):
+        if min_width < 1:
+            continue
+        frame_nibbles = block_nibbles[:, :min_width].reshape(-1)
+        payload_tetrads = frame_payload_tetrads(frame_nibbles)
+        if payload_tetrads is not None and tetrad_block_width(payload_tetrads) == min_width:
+            # Trailing zero tetrads leave no changed rows, so the block may be shorter than the payload
+            if len(frame_nibbles) < payload_tetrads:
+                frame_nibbles = np.pad(frame_nibbles, (0, payload_tetrads - len(frame_nibbles)))
+            return frame_nibbles[:payload_tetrads]
+    
+    raise ValueError('Frame block does not start with a frame or segment header')
 
-    if first_check_index == 0:
-        pass
+def decode_frame_nibbles(original, encoded, offset: tuple = None) -> np.ndarray:
+    # PNG frames (paths or bytes) in the supported format stream row by row against an array or path base canvas
+    if isinstance(encoded, (str, bytes, bytearray)):
+        png_header = read_png_header(encoded)
+        if png_rows_supported(png_header) and isinstance(original, (str, np.ndarray)):
+            return stream_frame_nibbles(as_rgba_array(original), encoded, offset)
+        if offset is None and png_header['offset'] != (0, 0):
+            offset = png_header['offset']
+    
+    # Otherwise compare the full frames channel by channel; every changed channel is a 1 bit
+    encoded_rgba = as_rgba_array(encoded)
+    if offset is None:
+        original_rgba = as_rgba_array(original, encoded_rgba.shape)
     else:
-        encoded_string_split = first_check_binary_data.split(ascii_bin_encode('<'), maxsplit = 4)
-        
-        decoded_id_desc = ascii_bin_decode(encoded_string_split[0])
-        decoded_md5_checksum = ascii_bin_decode(encoded_string_split[1])
-        decoded_nucleotide_type = ascii_bin_decode(encoded_string_split[2])
-        decoded_encoding_key = ascii_bin_decode(encoded_string_split[3])
+        original_rgba = as_rgba_array(original)
+        encoded_rgba = place_frame_rgba(encoded_rgba, offset, original_rgba)
+    difference_bits = original_rgba != encoded_rgba
+    
+    # Locate the centered data block; frames without differences carry no data
+    changed_pixels = difference_bits.any(axis=2)
+    changed_rows = np.flatnonzero(changed_pixels.any(axis=1))
+    changed_cols = np.flatnonzero(changed_pixels.any(axis=0))
+    if changed_rows.size == 0:
+        return None
+    top, bottom, left = changed_rows[0], changed_rows[-1] + 1, changed_cols[0]
+    
+    # Pack the block bits (RGBA order, most significant first) into one nibble per pixel, at the widest possible block width
+    max_width = encoded_rgba.shape[1] - 2 * left
+    block_nibbles = bytes_to_nibbles(np.packbits(difference_bits[top:bottom, left:left + max_width].reshape(-1)))[:(bottom - top) * max_width]
+    
+    return block_payload_nibbles(block_nibbles.reshape(bottom - top, max_width))
+
+def decode_frame_payload(original, encoded, offset: tuple = None) -> TetradPayload:
+    # Decode the frame block; its frame header gives the payload length
+    frame_nibbles = decode_frame_nibbles(original, encoded, offset)
+    if frame_nibbles is None:
+        return None
+    
+    return TetradPayload.from_nibbles(frame_nibbles)
+
+def decode_payload(decoded_payload: TetradPayload) -> (str, str, str, str, str):
+    # Decode a frame payload into its header fields and nucleotide sequence
+    decoded_id_desc, decoded_md5_checksum, decoded_nucleotide_type, decoded_encoding_key = decoded_payload.header_fields()
+    decoded_id, _, decoded_description = decoded_id_desc.partition(' ')
+    
+    decoded_sequence = tetra_nibble_decode(decoded_payload.sequence_nibbles, decoded_encoding_key, decoded_nucleotide_type).decode('latin-1')
+    
+    return (decoded_id, decoded_description, decoded_md5_checksum, decoded_nucleotide_type, decoded_sequence)
+
+def decode_frame(original, encoded, offset: tuple = None) -> (str, str, str, str, str):
+    # Decode the data embedded in a frame, or None for frames without data
+    decoded_payload = decode_frame_payload(original, encoded, offset)
+    if decoded_payload is None:
+        return None
+    
+    return decode_payload(decoded_payload)
+
+def read_indexed_frame_rgba(f, index_entry: dict, base_rgba: np.ndarray = None) -> np.ndarray:
+    # Read one indexed APNG frame as a full canvas, placing cropped frames on the base
+    frame_box, frame_png = read_apng_frame(f, index_entry)
+    frame_rgba = np.asarray(Image.open(io.BytesIO(frame_png)).convert("RGBA"))
+    if base_rgba is None:
+        return frame_rgba
+    
+    return place_frame_rgba(frame_rgba, frame_box[:2], base_rgba)
+
+def read_chromosome(apng_path: str, chromosome_id: str) -> (str, str, str):
+    # Find the chromosome's frames through the APNG frame index
+    apng_index = read_apng_index(apng_path)
+    if apng_index is None:
+        return scan_chromosome(apng_path, chromosome_id)
+    index_entries = [entry for entry in apng_index['frames']
+                     if entry.get('id') == chromosome_id or any(segment['id'] == chromosome_id for segment in entry.get('segments', []))]
+    if not index_entries:
+        raise KeyError(f'{chromosome_id} is not indexed in {apng_path}')
+    index_entry = index_entries[0]
+    
+    # Read only the base frame and the chromosome's frames
+    with open(apng_path, 'rb') as f:
+        base_rgba = read_indexed_frame_rgba(f, apng_index['frames'][0])
         
-        decoded_sequence = tetra_bin_decode(encoded_string_split[4], decoded_encoding_key)
-        if decoded_nucleotide_type == 'RNA':
-            if decoded_encoding_key == 'degenerate':
-                decoded_sequence = decoded_sequence.replace('T','U')
-            else:
-                decoded_sequence = decoded_sequence.replace('t','u').replace('T','U')
+        # Tiled layout: reassemble the record from its parts in every frame that holds one
+        if 'segments' in index_entry:
+            record_index = [segment['record'] for segment in index_entry['segments'] if segment['id'] == chromosome_id][0]
+            record_parts = []
+            for tile_entry in index_entries:
+                frame_box, frame_png = read_apng_frame(f, tile_entry)
+                frame_nibbles = decode_frame_nibbles(base_rgba, frame_png, frame_box[:2])
+                record_parts.extend(part for part in parse_tiled_frame(frame_nibbles) if part[0] == record_index)
+            reassembled_records = list(reassemble_tiled_records(record_parts))
+            if not reassembled_records:
+                raise ValueError(f'Tiled frames for {chromosome_id} do not hold the whole record')
+            decoded_payload = reassembled_records[0][1]
+        else:
+            frame_box, frame_png = read_apng_frame(f, index_entry)
+            decoded_payload = decode_frame_payload(base_rgba, frame_png, frame_box[:2])
+            if decoded_payload is None or len(decoded_payload) != index_entry['tetrads']:
+                raise ValueError(f'Frame {index_entry["frame"]} does not hold the indexed payload for {chromosome_id}')
     
+    # Check the decoded header against the index entry
+    decoded_id, decoded_description, decoded_md5_checksum, _, decoded_sequence = decode_payload(decoded_payload)
+    if fasta_record_id(decoded_id) != chromosome_id or decoded_md5_checksum != index_entry['md5']:
+        raise ValueError(f'Frame {index_entry["frame"]} header does not match the index entry for {chromosome_id}')
+    
+    return (decoded_id, decoded_description, decoded_sequence)
+
+def scan_chromosome(apng_path: str, chromosome_id: str) -> (str, str, str):
+    # Without a frame index, split the APNG and decode its frames in order until the chromosome turns up
+    with tempfile.TemporaryDirectory() as split_directory:
+        frame_paths = split_apng(apng_path, split_directory)
+        record_parts = []
+        for frame_path in frame_paths[1:]:
+            frame_nibbles = decode_frame_nibbles(frame_paths[0], frame_path)
+            if frame_nibbles is None:
+                continue
+            frame_parts = parse_tiled_frame(frame_nibbles)
+            if frame_parts:
+                record_parts.extend(frame_parts)
+                continue
+            decoded_id, decoded_description, _, _, decoded_sequence = decode_payload(TetradPayload.from_nibbles(frame_nibbles))
+            if fasta_record_id(decoded_id) == chromosome_id:
+                return (decoded_id, decoded_description, decoded_sequence)
+    
+    # Tiled layout: decode each reassembled record until one carries the chromosome
+    for _, decoded_payload in reassemble_tiled_records(record_parts):
+        decoded_id, decoded_description, _, _, decoded_sequence = decode_payload(decoded_payload)
+        if fasta_record_id(decoded_id) == chromosome_id:
+            return (decoded_id, decoded_description, decoded_sequence)
+    
+    raise KeyError(f'{chromosome_id} is not stored in {apng_path}')
+
+def first_qc_check(input_fasta_file: str, first_check_index: int, output_encoded_image_path: str, original_image_path: str, expected_md5_checksum: str = None):
+    # Use the checksum the caller already has; otherwise md5_checksum hashes the FASTA once and caches it
+    generated_md5_checksum = expected_md5_checksum or md5_checksum(input_fasta_file)
+    decoded_frame = decode_frame(original_image_path, output_encoded_image_path)
+    
+    # The unmodified base image carries no chromosome data
+    if decoded_frame is None:
+        print(f'{output_encoded_image_path}\nSKIPPED FIRST QC: NO ENCODED DATA')
+        return None
+    
+    _, _, decoded_md5_checksum, _, _ = decoded_frame
     if decoded_md5_checksum == generated_md5_checksum:
         print(f'{output_encoded_image_path}\nPASSES FIRST QC: MD5 IMAGE ENCODING/DECODING')
     else:
         print(f'MD5 CHECKSUMS FAILED FIRST QC\nCHECK FILE INTEGRITY FOR {output_encoded_image_path}')
 
-def second_qc_check(first_check_index: int, output_encoded_image_path: str, apng_image_list: list, original_rgba_values: list, input_fasta_file: str):
-    generated_md5_checksum = md5_checksum(input_fasta_file)
-    encoded_rgba_values, _ = get_rgba_values(output_encoded_image_path)    
-    second_check_binary_data = ''
-    difference_count = 0
-    for i, rgba in enumerate(original_rgba_values):
-        temp_tetrad = ''
-        for n, item in enumerate(rgba):
-            if rgba[n] == encoded_rgba_values[i][n]:        
-                temp_tetrad += '0'
-            else:
-                temp_tetrad += '1'
-                difference_count += 1
-        second_check_binary_data += temp_tetrad
-    if first_check_index == 0:
-        pass
-    else:    
-        second_check_binary_data = remove_zero_chunks(second_check_binary_data)
-        encoded_string_split = second_check_binary_data.split(ascii_bin_encode('<'), maxsplit = 4)
-        try:
-            decoded_ID_description = ascii_bin_decode(encoded_string_split[0])
-            decoded_ID = decoded_ID_description.split(' ', 1)[0]
-            decoded_description = decoded_ID_description.split(' ', 1)[1]
-        except IndexError:
-            decoded_ID_description = ascii_bin_decode(encoded_string_split[0][4:])
-            decoded_ID = decoded_ID_description.split(' ', 1)[0]
-            decoded_description = decoded_ID_description.split(' ', 1)[1]
-        decoded_md5_checksum = ascii_bin_decode(encoded_string_split[1])
-        decoded_nucleotide_type = ascii_bin_decode(encoded_string_split[2])
-        decoded_encoding_key = ascii_bin_decode(encoded_string_split[3])
-        decoded_sequence = tetra_bin_decode(encoded_string_split[4], decoded_encoding_key)
-        if decoded_nucleotide_type == 'RNA':
-            if decoded_encoding_key == 'degenerate':
-                decoded_sequence = decoded_sequence.replace('T','U')
-            elif decoded_encoding_key == 'confidence':
-                decoded_sequence = decoded_sequence.replace('t','u').replace('T','U')
-        
-        if decoded_md5_checksum == generated_md5_checksum:
-            print(f'{output_encoded_image_path}\nPASSES SECOND QC: MD5 APNG ENCODING/DECODING')
-            return decoded_ID, decoded_description, decoded_sequence
-        else:
-            print(f'MD5 CHECKSUMS FAILED SECOND QC;\nCHECK FILE INTEGRITY FOR {output_encoded_image_path}')
-            return None
+def second_qc_check(first_check_index: int, output_encoded_image_path: str, apng_image_list: list, original_rgba_values: np.ndarray, input_fasta_file: str, expected_md5_checksum: str = None):
+    generated_md5_checksum = expected_md5_checksum or md5_checksum(input_fasta_file)
+    decoded_frame = decode_frame(original_rgba_values, output_encoded_image_path)
+    
+    # The unmodified base image carries no chromosome data
+    if decoded_frame is None:
+        return None
+    
+    decoded_ID, decoded_description, decoded_md5_checksum, _, decoded_sequence = decoded_frame
+    if decoded_md5_checksum == generated_md5_checksum:
+        print(f'{output_encoded_image_path}\nPASSES SECOND QC: MD5 APNG ENCODING/DECODING')
+        return decoded_ID, decoded_description, decoded_sequence
+    else:
+        print(f'MD5 CHECKSUMS FAILED SECOND QC;\nCHECK FILE INTEGRITY FOR {output_encoded_image_path}')
+        return None
 
-def final_qc_check(extracted_results: list, output_fasta_file: str):
-   
-    # Filter out None values from results
-    extracted_results = [extracted_result for extracted_result in extracted_results if extracted_result is not None]
+def new_qc_report(frame_index: int, frame_image: str, record_id: str) -> dict:
+    # Empty (failing) QC report for one frame or record
+    return {'frame': frame_index, 'image': frame_image, 'id': record_id,
+            'header_ok': False, 'md5_ok': False, 'sequence_ok': False, 'passed': False, 'error': None}
+
+def check_decoded_record(report: dict, decoded_frame: tuple, expected_description: str, expected_sequence: bytes, expected_md5_checksum: str) -> (dict, tuple):
+    # Fill in the report by comparing a decoded record with its source record
+    decoded_ID, decoded_description, decoded_md5_checksum, _, decoded_sequence = decoded_frame
+    report['header_ok'] = f'{decoded_ID} {decoded_description}'.rstrip() == expected_description
+    report['md5_ok'] = decoded_md5_checksum == expected_md5_checksum
+    report['sequence_ok'] = decoded_sequence.encode('latin-1') == expected_sequence
+    report['passed'] = report['header_ok'] and report['md5_ok'] and report['sequence_ok']
+    
+    return (report, (decoded_ID, decoded_description, decoded_sequence))
+
+def verify_frame(frame_index: int, frame_image: str, record_id: str, expected_description: str, expected_sequence: bytes, expected_md5_checksum: str) -> (dict, tuple):
+    # Decode one frame against the shared base canvas and check it against its source record
+    report = new_qc_report(frame_index, frame_image, record_id)
+    try:
+        decoded_frame = decode_frame(shared_base['rgba'], frame_image)
+    except (ValueError, KeyError, OSError) as error:
+        report['error'] = f'{type(error).__name__}: {error}'
+        return (report, None)
+    
+    if decoded_frame is None:
+        report['error'] = 'NO ENCODED DATA'
+        return (report, None)
+    
+    return check_decoded_record(report, decoded_frame, expected_description, expected_sequence, expected_md5_checksum)
+
+def qc_frame_jobs(frame_images: list, fasta_records, expected_md5_checksum: str):
+    # verify_frame arguments pairing frame i with FASTA record i
+    return ((frame_index, frame_image, record_id, description, sequence, expected_md5_checksum)
+            for frame_index, (frame_image, (record_id, description, sequence)) in enumerate(zip(frame_images, fasta_records)))
+
+def parallel_qc_check(base_rgba: np.ndarray, frame_images: list, fasta_records, expected_md5_checksum: str, workers: int) -> list:
+    # Verify frame i against FASTA record i in worker processes, returning (report, record) in frame order
+    qc_results = list(map_with_shared_base(verify_frame, base_rgba, qc_frame_jobs(frame_images, fasta_records, expected_md5_checksum), workers))
+    
+    return collect_qc_results(qc_results, frame_images)
+
+def collect_qc_results(qc_results: list, frame_images: list) -> list:
+    # Frames without a source record (or records without a frame) fail the check
+    frame_count = len(qc_results)
+    for frame_index, frame_image in enumerate(frame_images[frame_count:], start=frame_count):
+        report = new_qc_report(frame_index, frame_image, None)
+        report['error'] = 'NO SOURCE RECORD'
+        qc_results.append((report, None))
+    
+    return sorted(qc_results, key=lambda qc_result: qc_result[0]['frame'])
+
+def decode_tile_worker(frame_index: int, frame_image: str) -> (int, list):
+    # Decode one tiled frame against the shared base canvas into its record parts
+    try:
+        frame_nibbles = decode_frame_nibbles(shared_base['rgba'], frame_image)
+    except (ValueError, OSError):
+        return (frame_index, [])
+    
+    return (frame_index, parse_tiled_frame(frame_nibbles) if frame_nibbles is not None else [])
+
+def parallel_tiled_qc_check(base_rgba: np.ndarray, frame_images: list, fasta_records, expected_md5_checksum: str, workers: int) -> list:
+    # Decode tiled frames in worker processes, reassemble the records in order and check each against its source record
+    decoded_tiles = in_frame_order(map_with_shared_base(decode_tile_worker, base_rgba, enumerate(frame_images), workers))
+    
+    return check_tiled_records(decoded_tiles, frame_images, fasta_records, expected_md5_checksum)
+
+def check_tiled_records(decoded_tiles, frame_images: list, fasta_records, expected_md5_checksum: str) -> list:
+    # Reassemble records from (frame_index, parts) in frame order and check each against its source record
+    record_frames = {}
+    
+    def tile_parts():
+        # Remember which frames held each record while streaming the parts
+        for frame_index, parts in decoded_tiles:
+            for part in parts:
+                record_frames.setdefault(part[0], []).append(frame_index)
+                yield part
     
-    # Create DataFrame from results
-    extracted_df = pd.DataFrame(extracted_results, columns=['ID', 'Description', 'Sequence']).set_index('ID')
+    reassembled_records = reassemble_tiled_records(tile_parts())
+    completed_records = {}
+    qc_results = []
+    for record_index, (record_id, description, sequence) in enumerate(fasta_records):
+        # Pull reassembled records until this one completes; records complete in order, so a later one means it never will
+        while record_index not in completed_records:
+            next_record = next(reassembled_records, None)
+            if next_record is None:
+                break
+            completed_records[next_record[0]] = next_record[1]
+            if next_record[0] > record_index:
+                break
+        
+        frame_indices = record_frames.get(record_index, [])
+        report = new_qc_report(frame_indices[0] if frame_indices else None,
+                               frame_images[frame_indices[0]] if frame_indices else None, record_id)
+        report['frames'] = frame_indices
+        decoded_payload = completed_records.pop(record_index, None)
+        if decoded_payload is None:
+            report['error'] = 'RECORD NOT REASSEMBLED'
+            qc_results.append((report, None))
+            continue
+        try:
+            qc_results.append(check_decoded_record(report, decode_payload(decoded_payload), description, sequence, expected_md5_checksum))
+        except (ValueError, KeyError) as error:
+            report['error'] = f'{type(error).__name__}: {error}'
+            qc_results.append((report, None))
+    
+    return qc_results
+
+def print_qc_report(qc_stage: str, qc_reports: list) -> bool:
+    # Print one PASS/FAIL line per frame and a summary; returns True if every frame passed
+    for report in qc_reports:
+        status = 'PASS' if report['passed'] else 'FAIL'
+        detail = f" ({report['error']})" if report['error'] else ''
+        frame_label = f"{report['frame']:03d}" if report['frame'] is not None else '---'
+        print(f"{status} {qc_stage} frame {frame_label} {report['id']}: {report['image']}{detail}")
     
-    # Reconstruct FNA file from Results Dataframe
-    reconstruct_fna_from_df(extracted_df, output_fasta_file)
+    passed_count = sum(report['passed'] for report in qc_reports)
+    print(f'{qc_stage}: {passed_count}/{len(qc_reports)} FRAMES PASSED')
     
-    # Genearte an md5 checksum for the reconstructed file
-    generated_md5_checksum = md5_checksum(output_fasta_file)
+    return passed_count == len(qc_reports)
+
+def final_qc_check(extracted_results, output_fasta_file: str, expected_md5_checksum: str, line_width: int = FASTA_LINE_WIDTH) -> bool:
+   
+    # Stream the decoded records (a list or generator), skipping None values, straight into the FNA file
+    write_fasta_records((extracted_result for extracted_result in extracted_results if extracted_result is not None), output_fasta_file, line_width)
     
-    if verify_file(output_fasta_file, generated_md5_checksum):
+    # The reconstructed file must hash to the input FASTA's checksum
+    if verify_file(output_fasta_file, expected_md5_checksum):
         print('PASSES FINAL QC: MD5 FNA DECODING CHECKSUM')
+        return True
     else:
         # print('CORRECTING FOR ENDFILE-NEWLINE ERROR')
-        # Read the file contents into a variable
-        with open(output_fasta_file, 'r') as file:
-            contents = file.readlines()
-        
         # Check if the last character is a newline and remove it if it is
-        if contents and contents[-1].endswith('\n'):
-            contents[-1] = contents[-1].rstrip('\n')
-        
-        # Write the modified contents back to the file
-        with open(output_fasta_file, 'w') as file:
-            file.writelines(contents)
-        if verify_file(output_fasta_file, generated_md5_checksum):
+        with open(output_fasta_file, 'rb+') as file:
+            file.seek(0, os.SEEK_END)
+            if file.tell() > 0:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) == b'\n':
+                    file.truncate(file.tell() - 1)
+        if verify_file(output_fasta_file, expected_md5_checksum):
             print('PASSES FINAL QC: MD5 FNA DECODING CHECKSUM')
+            return True
         else:
             print(f'MD5 CHECKSUMS FAILED FINAL QC;\nCHECK FILE INTEGRITY FOR {output_fasta_file}')
+            return False
  
 def verify_file(input_file_path: str, expected_md5_checksum: str) -> bool:
     # Calculate the input file's md5 checksum
@@ -240,11 +520,7 @@ if __name__ == '__main__':
     for idx, row in tqdm(fasta_df.iterrows(), total=fasta_df.shape[0], desc='Processing Sequences', ncols=100):
         description = row['Description']
         sequence = row['Sequence']
-        sequence_binary, nucleotide_type, encoding_key = tetra_bin_encode(sequence)
-        md5_desc_type_enc = f'{description}<{generated_md5_checksum}<{nucleotide_type}<{encoding_key}<'
-        md5_desc_type_enc_binary = ascii_bin_encode(md5_desc_type_enc)
-        data_binary = md5_desc_type_enc_binary + sequence_binary
-        binary_data_list.append(data_binary)
+        binary_data_list.append(tetra_record_encode(description, sequence, generated_md5_checksum))
     
     # Determine the largest image needed for encoding
     max_width, max_height = get_largest_image_size(binary_data_list)
@@ -271,17 +547,17 @@ if __name__ == '__main__':
     
     with ThreadPoolExecutor() as executor:
         # Use executor.map() to call first_qc_check with these arguments
-        executor.map(first_qc_check, [input_fasta_file]*len(encoded_image_list), range(len(encoded_image_list)), encoded_image_list)
+        executor.map(first_qc_check, [input_fasta_file]*len(encoded_image_list), range(len(encoded_image_list)), encoded_image_list, [original_image_copy]*len(encoded_image_list), [generated_md5_checksum]*len(encoded_image_list))
 
     # SECOND QC Check
     print('\nSTARTING SECOND QC CHECK: ANIMATED PNG ENCODING/DECODING')
     apng_image_list = find_file_types(examination_directory, '.png')
     apng_image_list = [f'{examination_directory}/{image_path}' for image_path in apng_image_list]
-    original_rgba_values, width = get_rgba_values(apng_image_list[0])
+    original_rgba_values, width = get_rgba_array(apng_image_list[0])
     
     with ThreadPoolExecutor() as executor:
-        extracted_results = list(executor.map(second_qc_check, range(len(encoded_image_list)), encoded_image_list, [apng_image_list] * len(encoded_image_list), [original_rgba_values] * len(encoded_image_list), [input_fasta_file] * len(encoded_image_list)))
+        extracted_results = list(executor.map(second_qc_check, range(len(encoded_image_list)), encoded_image_list, [apng_image_list] * len(encoded_image_list), [original_rgba_values] * len(encoded_image_list), [input_fasta_file] * len(encoded_image_list), [generated_md5_checksum] * len(encoded_image_list)))
     
     # FINAL QC Check
     print('\nSTARTING FINAL QC CHECK: FNA DECODING')
-    final_qc_check(extracted_results, output_fasta_file)
\ No newline at end of file
+    final_qc_check(extracted_results, output_fasta_file, generated_md5_checksum, fasta_line_width(input_fasta_file))
\ No newline at end of file
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:20:44 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 15:20:44 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
+### STAGE PROFILING FUNCTIONS
+import sys
+import json
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+def reset_peak_rss():
+    # Reset the kernel's resident set high-water mark so each stage reports its own peak (Linux only)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def rusage_mb(rusage_maxrss: int) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return rusage_maxrss / (1024 * 1024) if sys.platform == 'darwin' else rusage_maxrss / 1024
+
+def peak_rss_mb() -> float:
+    # Peak resident set size since the last reset, falling back to the process lifetime peak
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    
+    return rusage_mb(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+def child_cpu_seconds() -> float:
+    # CPU time of finished child processes, i.e. worker pools that have been shut down
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return child_usage.ru_utime + child_usage.ru_stime
+
+class StageProfiler:
+    # Wall time, CPU time, bytes processed and peak memory per pipeline stage; every call is a no-op when disabled
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.stages = {}
+        self.start_time = time.perf_counter()
+
+    def get_stage(self, stage_name: str) -> dict:
+        # Stages are reported in the order they first ran; repeated calls accumulate
+        if stage_name not in self.stages:
+            self.stages[stage_name] = {'stage': stage_name, 'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes': 0}
+        return self.stages[stage_name]
+
+    @contextmanager
+    def measure_stage(self, stage_name: str, stage_bytes: int):
+        # Top-level stage: also measures worker CPU time and the stage's own memory peak
+        stage = self.get_stage(stage_name)
+        reset_peak_rss()
+        start_child_cpu = child_cpu_seconds()
+        start_cpu = time.process_time()
+        start_time = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage['wall_seconds'] += time.perf_counter() - start_time
+            stage['cpu_seconds'] += time.process_time() - start_cpu
+            stage['child_cpu_seconds'] = stage.get('child_cpu_seconds', 0.0) + child_cpu_seconds() - start_child_cpu
+            stage['peak_rss_mb'] = max(stage.get('peak_rss_mb', 0.0), peak_rss_mb())
+            stage['bytes'] += stage_bytes
+            stage['calls'] += 1
+
+    def stage(self, stage_name: str, stage_bytes: int = 0):
+        # Context manager for one pipeline stage; the yielded dict's 'bytes' can be added to while it runs
+        if not self.enabled:
+            return nullcontext({'bytes': 0})
+        return self.measure_stage(stage_name, stage_bytes)
+
+    def add(self, stage_name: str, wall_seconds: float, stage_bytes: int = 0, cpu_seconds: float = 0.0):
+        # Accumulate work timed elsewhere, such as frames timed inside worker processes
+        if not self.enabled:
+            return
+        stage = self.get_stage(stage_name)
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['bytes'] += stage_bytes
+        stage['calls'] += 1
+
+    def timed(self, stage_name: str, stage_bytes: int = 0):
+        # Light context manager for work repeated inside a stage, e.g. once per record; wall and CPU time only
+        if not self.enabled:
+            return nullcontext()
+        return self.measure_step(stage_name, stage_bytes)
+
+    @contextmanager
+    def measure_step(self, stage_name: str, stage_bytes: int):
+        start_cpu = time.process_time()
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage_name, time.perf_counter() - start_time, stage_bytes, time.process_time() - start_cpu)
+
+    def timed_iter(self, stage_name: str, iterable, item_bytes=None):
+        # Time only the work of producing each item (such as parsing a FASTA record), not what the caller does with it
+        if not self.enabled:
+            return iterable
+        return self.measure_iter(stage_name, iterable, item_bytes)
+
+    def measure_iter(self, stage_name: str, iterable, item_bytes):
+        iterator = iter(iterable)
+        while True:
+            start_cpu = time.process_time()
+            start_time = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(stage_name, time.perf_counter() - start_time, item_bytes(item) if item_bytes else 0, time.process_time() - start_cpu)
+            yield item
+
+    def report(self, run_info: dict = None) -> dict:
+        # Machine-readable report, with throughput for stages that processed bytes
+        stages = []
+        for stage in self.stages.values():
+            stage = dict(stage)
+            stage['mb_per_second'] = stage['bytes'] / stage['wall_seconds'] / 1e6 if stage['bytes'] and stage['wall_seconds'] else None
+            stages.append(stage)
+        
+        return {'run': run_info or {},
+                'total_wall_seconds': time.perf_counter() - self.start_time,
+                'max_child_rss_mb': rusage_mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+                'stages': stages}
+
+    def write_report(self, report_path: str, run_info: dict = None):
+        # Write the JSON report and print a one-line summary per stage
+        if not self.enabled:
+            return
+        profile_report = self.report(run_info)
+        with open(report_path, 'w') as f:
+            # NumPy scalars (canvas sizes, frame boxes) are written as plain numbers
+            json.dump(profile_report, f, indent=2, default=lambda value: value.item())
+        
+        print('\nSTAGE PROFILE')
+        for stage in profile_report['stages']:
+            throughput = f"{stage['mb_per_second']:>9.2f} MB/s" if stage['mb_per_second'] else ' ' * 14
+            peak_memory = f"{stage['peak_rss_mb']:>9.1f} MB" if 'peak_rss_mb' in stage else ''
+            print(f"{stage['stage']:<18}{stage['wall_seconds']:>9.3f}s{stage['cpu_seconds']:>9.3f}s cpu{throughput}{peak_memory}")
+        print(f"Profile report written to {report_path}")
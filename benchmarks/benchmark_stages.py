@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 14:05:12 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
+### STAGE BENCHMARKS
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from PIL import Image
+
+# Add the repository folder to sys.path
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if repository_directory not in sys.path:
+    sys.path.append(repository_directory)
+
+from EncDec.encoding_decoding_funcs import (tetra_bin_encode,
+                                            tetra_record_encode)
+from NucImg.nucleotide_image_funcs import (get_canvas_size,
+                                           tetrad_count,
+                                           resize_image,
+                                           get_rgba_array,
+                                           process_tetrad_image,
+                                           png_dir_apng_gen,
+                                           split_apng,
+                                           natural_sort_key)
+from NucImg.png_chunk_funcs import APNGStreamWriter, compress_rgba_frame, png_compression_settings, PNG_COMPRESSION_PRESETS
+from NucQC.nucleotide_qc_funcs import (md5_checksum,
+                                       decode_frame_payload,
+                                       decode_payload)
+from CustFasta.custom_fasta_funcs import iter_fasta_records, mmap_fasta_records
+from Profiling.profiling_funcs import reset_peak_rss, peak_rss_mb
+
+# Synthetic genome alphabets
+BENCHMARK_ALPHABETS = {'acgt': b'ACGT',
+                       'iupac': b'ACGTNRYKMSWBDHV',
+                       'softmasked': b'ACGTacgt'}
+FASTA_LINE_WIDTH = 80
+DEFAULT_IMAGE = os.path.join(repository_directory, 'tests', 'small_ex.png')
+
+def generate_synthetic_sequence(rng: np.random.Generator, length: int, alphabet: str) -> bytes:
+    # Random bases, with N-runs for IUPAC genomes and lowercase repeat intervals for soft-masked ones
+    if alphabet == 'acgt':
+        return np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(0, 4, length)].tobytes()
+    sequence = np.frombuffer(b'ACGT', dtype=np.uint8)[rng.integers(0, 4, length)]
+    interval_count = max(length // 10000, 1)
+    interval_starts = rng.integers(0, length, interval_count)
+    interval_lengths = rng.integers(50, 2000, interval_count)
+    if alphabet == 'iupac':
+        ambiguity_codes = np.frombuffer(b'RYKMSWBDHV', dtype=np.uint8)
+        ambiguous_positions = rng.integers(0, length, max(length // 1000, 1))
+        sequence[ambiguous_positions] = ambiguity_codes[rng.integers(0, ambiguity_codes.size, ambiguous_positions.size)]
+        for start, run_length in zip(interval_starts, interval_lengths):
+            sequence[start:start + run_length] = ord('N')
+    elif alphabet == 'softmasked':
+        for start, run_length in zip(interval_starts, interval_lengths):
+            sequence[start:start + run_length] |= 0x20
+
+    return sequence.tobytes()
+
+def write_synthetic_fasta(fasta_path: str, total_size: int, record_count: int, alphabet: str, seed: int):
+    # Split the genome into records of similar length and write them wrapped at the usual line width
+    rng = np.random.default_rng(seed)
+    record_lengths = np.full(record_count, total_size // record_count)
+    record_lengths[:total_size % record_count] += 1
+    with open(fasta_path, 'wb') as f:
+        for record_index, record_length in enumerate(record_lengths):
+            sequence = generate_synthetic_sequence(rng, int(record_length), alphabet)
+            f.write(f'>synthetic_{record_index + 1} synthetic {alphabet} record {record_index + 1}\n'.encode('ascii'))
+            for line_start in range(0, len(sequence), FASTA_LINE_WIDTH):
+                f.write(sequence[line_start:line_start + FASTA_LINE_WIDTH] + b'\n')
+
+def time_stage(stage_function, nucleotide_bytes: int, repeats: int) -> dict:
+    # Best of several runs, with the nucleotide throughput and peak memory of the stage
+    stage_seconds = []
+    reset_peak_rss()
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        stage_function()
+        stage_seconds.append(time.perf_counter() - start_time)
+    best_seconds = min(stage_seconds)
+
+    return {'seconds': best_seconds,
+            'all_seconds': stage_seconds,
+            'nucleotide_bytes': nucleotide_bytes,
+            'mb_per_second': nucleotide_bytes / best_seconds / 1e6 if best_seconds else None,
+            'peak_rss_mb': peak_rss_mb()}
+
+def get_git_commit() -> str:
+    # Commit of the benchmarked tree, so results can be compared across commits
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repository_directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(fasta_path: str, image_path: str, work_directory: str, repeats: int, compression: dict = None) -> dict:
+    # Load the records once; every stage works from memory or the previous stage's files
+    records = list(iter_fasta_records(fasta_path))
+    nucleotide_bytes = sum(len(sequence) for _, _, sequence in records)
+    fasta_md5_checksum = md5_checksum(fasta_path)
+    results = {}
+
+    # FASTA parsing, with the chunked streaming reader and the memory-mapped parser
+    results['iter_fasta_records'] = time_stage(lambda: [len(sequence) for _, _, sequence in iter_fasta_records(fasta_path)], nucleotide_bytes, repeats)
+    results['mmap_fasta_records'] = time_stage(lambda: [len(sequence) for _, _, sequence in mmap_fasta_records(fasta_path)], nucleotide_bytes, repeats)
+
+    # Nucleotide encoding
+    results['tetra_bin_encode'] = time_stage(lambda: [tetra_bin_encode(sequence) for _, _, sequence in records], nucleotide_bytes, repeats)
+    payloads = [tetra_record_encode(description, sequence, fasta_md5_checksum) for _, description, sequence in records]
+
+    # Base canvas sized for the largest record
+    canvas_width, canvas_height = get_canvas_size([tetrad_count(payload) for payload in payloads])
+    base_image_path = os.path.join(work_directory, 'base.png')
+    shutil.copyfile(image_path, base_image_path)
+    resize_image(base_image_path, canvas_width, canvas_height).save(base_image_path)
+    base_rgba, _ = get_rgba_array(base_image_path)
+
+    # Embedding each record and saving its frame
+    frame_directory = os.path.join(work_directory, 'frames')
+    os.makedirs(frame_directory, exist_ok=True)
+    frame_paths = [os.path.join(frame_directory, f'chrom_{idx + 1}.png') for idx in range(len(payloads))]
+    results['process_tetrad_image'] = time_stage(lambda: [process_tetrad_image(base_image_path, payload, frame_path, compression)
+                                                          for payload, frame_path in zip(payloads, frame_paths)], nucleotide_bytes, repeats)
+
+    # Assembling the frames into an APNG, with the legacy directory builder and the streaming writer
+    apng_path = os.path.join(work_directory, 'benchmark.apng')
+    results['png_dir_apng_gen'] = time_stage(lambda: png_dir_apng_gen(frame_directory, apng_path), nucleotide_bytes, repeats)
+    def write_apng_stream():
+        with APNGStreamWriter(apng_path, canvas_width, canvas_height) as apng_writer:
+            apng_writer.append_rgba(base_rgba, compression)
+            for frame_path in frame_paths:
+                apng_writer.append(compress_rgba_frame(get_rgba_array(frame_path)[0], compression))
+    results['apng_stream_writer'] = time_stage(write_apng_stream, nucleotide_bytes, repeats)
+
+    # Splitting the APNG back into frames
+    split_directory = os.path.join(work_directory, 'split')
+    os.makedirs(split_directory, exist_ok=True)
+    results['split_apng'] = time_stage(lambda: split_apng(apng_path, split_directory), nucleotide_bytes, repeats)
+    split_paths = sorted([os.path.join(split_directory, f) for f in os.listdir(split_directory)], key=natural_sort_key)[1:]
+
+    # QC decoding: frame difference to tetrad payload, then payload to header fields and sequence
+    encoded_frames = [get_rgba_array(split_path)[0] for split_path in split_paths]
+    results['qc_decode_frame_payload'] = time_stage(lambda: [decode_frame_payload(base_rgba, encoded_rgba) for encoded_rgba in encoded_frames], nucleotide_bytes, repeats)
+    decoded_payloads = [decode_frame_payload(base_rgba, encoded_rgba) for encoded_rgba in encoded_frames]
+    results['qc_decode_payload'] = time_stage(lambda: [decode_payload(decoded_payload) for decoded_payload in decoded_payloads], nucleotide_bytes, repeats)
+
+    # Make sure the benchmarked round trip is still lossless
+    decoded_sequences = [decode_payload(decoded_payload)[4].encode('latin-1') for decoded_payload in decoded_payloads]
+    if decoded_sequences != [sequence for _, _, sequence in records]:
+        raise ValueError('Benchmark round trip did not reproduce the input sequences')
+
+    return {'canvas': [canvas_width, canvas_height], 'records': len(records), 'nucleotide_bytes': nucleotide_bytes, 'stages': results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the encode, embed, APNG and QC stages on a synthetic genome.")
+    parser.add_argument("--size", type=float, default=1.0, help="Total genome size in Mbp")
+    parser.add_argument("--records", type=int, default=4, help="Number of FASTA records")
+    parser.add_argument("--alphabet", choices=list(BENCHMARK_ALPHABETS), default='acgt', help="Pure ACGT, degenerate IUPAC with N-runs, or soft-masked ACGTacgt")
+    parser.add_argument("--image", default=DEFAULT_IMAGE, help="Base image for the frames")
+    parser.add_argument("--png-compression", choices=list(PNG_COMPRESSION_PRESETS), default='default', help="PNG compression preset for the frames")
+    parser.add_argument("--png-threads", type=int, default=1, help="Threads compressing blocks of each large frame")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per stage; the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic genome")
+    parser.add_argument("--output", default='benchmark_results.json', help="JSON results file")
+    parser.add_argument("--keep", action='store_true', help="Keep the generated FASTA and frames")
+    args = parser.parse_args()
+
+    # Everything is generated in a scratch directory so runs do not touch the tests folder
+    work_directory = tempfile.mkdtemp(prefix='nbt_benchmark_')
+    try:
+        fasta_path = os.path.join(work_directory, f'synthetic_{args.alphabet}.fna')
+        write_synthetic_fasta(fasta_path, int(args.size * 1e6), args.records, args.alphabet, args.seed)
+        benchmark_results = run_benchmarks(fasta_path, args.image, work_directory, args.repeats, png_compression_settings(args.png_compression, threads=args.png_threads))
+    finally:
+        if args.keep:
+            print(f'Benchmark files kept in {work_directory}')
+        else:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    # Record the parameters and environment with the timings so runs can be compared across commits
+    benchmark_results.update({'commit': get_git_commit(),
+                              'parameters': {'size_mbp': args.size, 'records': args.records, 'alphabet': args.alphabet,
+                                             'image': os.path.basename(args.image), 'repeats': args.repeats, 'seed': args.seed,
+                                             'png_compression': args.png_compression, 'png_threads': args.png_threads},
+                              'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pillow': Image.__version__,
+                                              'platform': platform.platform(), 'cpu_count': os.cpu_count()}})
+    with open(args.output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+
+    for stage_name, stage_result in benchmark_results['stages'].items():
+        print(f"{stage_name:<26}{stage_result['seconds']:>9.3f}s{stage_result['mb_per_second']:>10.2f} MB/s{stage_result['peak_rss_mb']:>10.1f} MB")
+    print(f'Results written to {args.output}')
+
+if __name__ == '__main__':
+    main()
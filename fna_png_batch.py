@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 16:42:08 2026
+
+@author: ian.michael.bollinger@gmail.com
+"""
+### BATCH FUNCTIONS
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+
+# Get Working Directory and
+working_directory = os.getcwd()
+
+# Add the absolute folder path to sys.path
+if working_directory not in sys.path:
+    sys.path.append(working_directory)
+
+from fna_png_coder import (add_pipeline_arguments,
+                           get_pipeline_options,
+                           create_genome_directories,
+                           scan_fasta,
+                           plan_frames,
+                           iter_frame_payloads,
+                           frame_index_info)
+from NucImg.nucleotide_image_funcs import (SharedCanvasPool,
+                                           encode_frame_worker,
+                                           split_apng,
+                                           get_rgba_array)
+from NucQC.nucleotide_qc_funcs import (verify_frame,
+                                       decode_tile_worker,
+                                       qc_frame_jobs,
+                                       collect_qc_results,
+                                       check_tiled_records,
+                                       print_qc_report,
+                                       final_qc_check)
+from NucImg.canvas_cache_funcs import get_base_canvas
+from NucImg.png_chunk_funcs import (APNGStreamWriter,
+                                    write_png_file,
+                                    compress_rgba_frame,
+                                    APNG_DISPOSE_OP_NONE,
+                                    APNG_DISPOSE_OP_PREVIOUS)
+from CustFasta.custom_fasta_funcs import iter_fasta_records, cache_md5_checksum, fasta_line_width
+from Profiling.profiling_funcs import StageProfiler
+
+def read_batch_manifest(manifest_file: str, output_root: str) -> list:
+    # One genome per line: FASTA<TAB>image[<TAB>output root]; blank lines and '#' comments are skipped
+    # Relative paths are taken from the manifest's folder; genome names are the FASTA names, numbered when repeated
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_file))
+    genomes = []
+    genome_names = set()
+    with open(manifest_file, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            fields = [field.strip() for field in line.split('\t')]
+            if len(fields) not in (2, 3):
+                raise ValueError(f'{manifest_file} line {line_number}: expected FASTA<TAB>image[<TAB>output root]')
+            fasta_file, image_file = (os.path.join(manifest_directory, field) for field in fields[:2])
+            genome_root = os.path.join(manifest_directory, fields[2]) if len(fields) == 3 else output_root
+
+            genome_name = os.path.splitext(os.path.basename(fasta_file))[0]
+            unique_name = genome_name
+            for copy_number in itertools.count(2):
+                if unique_name not in genome_names:
+                    break
+                unique_name = f'{genome_name}_{copy_number}'
+            genome_names.add(unique_name)
+            genomes.append({'name': unique_name, 'fasta': fasta_file, 'image': image_file, 'root': genome_root})
+
+    return genomes
+
+def start_genome(genome: dict, pool: SharedCanvasPool, options: dict):
+    # Set up a scanned genome: base canvas published to the workers, base copy saved, APNG opened and frame jobs queued
+    name = genome['name']
+    genome['stage'] = 'start'
+    cache_md5_checksum(genome['fasta'], genome['md5'])
+    max_width, max_height, tile_layout, frame_count = plan_frames(genome['tetrad_counts'], options['max_canvas'])
+    frame_name = 'tile' if tile_layout is not None else 'chrom'
+    output_directory, examination_directory = create_genome_directories(os.path.join(genome['root'], name))
+    output_apng_file = f'{output_directory}/{name}.apng'
+
+    # Genomes sharing artwork at the same canvas size share one published canvas
+    base_rgba, canvas_cache_hit = get_base_canvas(genome['image'], max_width, max_height, options['canvas_cache'], options['canvas_cache_bytes'])
+    canvas = pool.publish(base_rgba, (os.path.abspath(genome['image']), max_width, max_height))
+    write_png_file(f'{output_directory}/{name}.png', max_width, max_height, compress_rgba_frame(base_rgba, options['compression']))
+    print(f'{name}: base canvas {max_width}x{max_height} {"loaded from cache" if canvas_cache_hit else "prepared"}, {frame_count} frames')
+
+    apng_writer = APNGStreamWriter(output_apng_file, max_width, max_height)
+    apng_writer.append_rgba(base_rgba, options['compression'])
+    encoded_image_list = [f'{output_directory}/{name}_{frame_name}_{idx + 1}.png' for idx in range(frame_count)]
+    delta_frames = options['apng_mode'] == 'delta'
+    frame_payloads = iter_frame_payloads(genome['fasta'], genome['md5'], tile_layout, scanned_sections=genome['scanned_sections'])
+    genome.update({'stage': 'encode', 'canvas': canvas, 'base_rgba': base_rgba, 'tile_layout': tile_layout, 'frame_count': frame_count,
+                   'output_directory': output_directory, 'examination_directory': examination_directory, 'apng_file': output_apng_file,
+                   'apng_writer': apng_writer, 'encoded_image_list': encoded_image_list, 'finished_frames': {}, 'next_frame': 0,
+                   'jobs': (('frame', encode_frame_worker, canvas, (idx, frame_payload, encoded_image_list[idx], delta_frames, options['compression']))
+                            for idx, frame_payload in enumerate(frame_payloads))})
+
+def add_frame(genome: dict, frame_result: tuple, options: dict, profiler: StageProfiler):
+    # Hold frames that finished early and append the rest to the APNG in order
+    dispose_op = APNG_DISPOSE_OP_PREVIOUS if options['apng_mode'] == 'delta' else APNG_DISPOSE_OP_NONE
+    genome['finished_frames'][frame_result[0]] = frame_result
+    while genome['next_frame'] in genome['finished_frames']:
+        idx, _, compressed_frame, frame_box, frame_seconds = genome['finished_frames'].pop(genome['next_frame'])
+        frame_info = frame_index_info(idx, genome['record_ids'], genome['tetrad_counts'], genome['tile_layout'], genome['md5'])
+        with profiler.timed('apng_build', len(compressed_frame)):
+            genome['apng_writer'].append(compressed_frame, frame_box, dispose_op=dispose_op, frame_info=frame_info)
+        profiler.add('frame_embed', frame_seconds, frame_box[2] * frame_box[3] * 4)
+        genome['next_frame'] += 1
+
+def queue_qc_jobs(genome: dict, apng_image_list: list, pool: SharedCanvasPool):
+    # FIRST QC checks the saved frames and SECOND QC the frames split from the APNG, both against the base canvas
+    # The split base frame is the canvas itself unless the APNG was altered, in which case it is published separately
+    split_base_rgba, _ = get_rgba_array(apng_image_list[0])
+    if np.array_equal(split_base_rgba, genome['base_rgba']):
+        genome['split_canvas'] = genome['canvas']
+    else:
+        genome['split_canvas'] = pool.publish(split_base_rgba)
+    genome['qc_results'] = {'first': [], 'second': []}
+    genome['apng_image_list'] = apng_image_list[1:]
+
+    def check_jobs(qc_pass: str, canvas: tuple, frame_images: list):
+        # Tiled frames are decoded into record parts and reassembled once every tile is back
+        if genome['tile_layout'] is not None:
+            return ((qc_pass, decode_tile_worker, canvas, (idx, frame_image)) for idx, frame_image in enumerate(frame_images))
+        return ((qc_pass, verify_frame, canvas, job) for job in qc_frame_jobs(frame_images, iter_fasta_records(genome['fasta']), genome['md5']))
+
+    genome.update({'stage': 'qc',
+                   'jobs': itertools.chain(check_jobs('first', genome['canvas'], genome['encoded_image_list']),
+                                           check_jobs('second', genome['split_canvas'], genome['apng_image_list']))})
+
+def finish_genome(genome: dict, pool: SharedCanvasPool, options: dict) -> bool:
+    # Report both QC passes, rebuild the FASTA from the APNG records and release the canvases
+    name = genome['name']
+    qc_passed = {}
+    for qc_pass, frame_images in (('first', genome['encoded_image_list']), ('second', genome['apng_image_list'])):
+        qc_results = genome['qc_results'][qc_pass]
+        if genome['tile_layout'] is not None:
+            qc_results = check_tiled_records(sorted(qc_results), frame_images, iter_fasta_records(genome['fasta']), genome['md5'])
+        else:
+            qc_results = collect_qc_results(qc_results, frame_images)
+        print()
+        qc_passed[qc_pass] = print_qc_report(f'{name} {qc_pass.upper()} QC', [report for report, _ in qc_results])
+        genome['qc_results'][qc_pass] = qc_results
+
+    print(f'\n{name}: STARTING FINAL QC CHECK: FNA DECODING')
+    line_width = options['line_width'] if options['line_width'] is not None else fasta_line_width(genome['fasta'])
+    extracted_results = (record for report, record in genome['qc_results']['second'] if report['passed'])
+    qc_passed['final'] = final_qc_check(extracted_results, f"{genome['examination_directory']}/{os.path.basename(genome['fasta'])}", genome['md5'], line_width)
+
+    if genome['split_canvas'] != genome['canvas']:
+        pool.release(genome['split_canvas'])
+    pool.release(genome['canvas'])
+    genome.update({'stage': 'done', 'qc_passed': qc_passed, 'seconds': time.perf_counter() - genome['start_time'],
+                   'base_rgba': None, 'qc_results': None, 'jobs': None})
+
+    return all(qc_passed.values())
+
+def fail_genome(genome: dict, error: Exception):
+    # Stop queueing a genome's jobs after an error and close its APNG; its canvases are released once its running jobs are back
+    if genome.get('error') is None:
+        genome['error'] = f'{genome["stage"]}: {type(error).__name__}: {error}'
+        print(f"{genome['name']}: FAILED during {genome['error']}")
+    genome['jobs'] = None
+    if genome.get('apng_writer') is not None:
+        genome['apng_writer'].close()
+        genome['apng_writer'] = None
+
+def release_failed_genome(genome: dict, pool: SharedCanvasPool):
+    # Free whatever canvases the failed genome had published and mark it done
+    if genome.get('split_canvas') is not None and genome['split_canvas'] != genome['canvas']:
+        pool.release(genome['split_canvas'])
+    if genome.get('canvas') is not None:
+        pool.release(genome['canvas'])
+    genome.update({'stage': 'done', 'canvas': None, 'split_canvas': None, 'seconds': time.perf_counter() - genome['start_time'],
+                   'base_rgba': None, 'qc_results': None, 'finished_frames': None, 'jobs': None, 'scanned_sections': None})
+
+def advance_genome(genome: dict, pool: SharedCanvasPool, options: dict):
+    # Move a genome whose queued jobs have all finished on to its next stage
+    if genome.get('error') is not None:
+        release_failed_genome(genome, pool)
+    elif genome['stage'] == 'encode':
+        genome['apng_writer'].close()
+        genome['apng_writer'] = None
+        genome['scanned_sections'] = None
+        genome['stage'] = 'split'
+        genome['jobs'] = iter([('split', split_apng, None, (genome['apng_file'], genome['examination_directory'], options['compression']))])
+    elif genome['stage'] == 'qc':
+        finish_genome(genome, pool, options)
+
+def handle_result(genome: dict, job_kind: str, result, pool: SharedCanvasPool, options: dict, profiler: StageProfiler):
+    # Route a finished job's result to its genome
+    if job_kind == 'scan':
+        genome['record_ids'], genome['tetrad_counts'], genome['md5'], genome['scanned_sections'] = result
+        genome['fasta_bytes'] = os.path.getsize(genome['fasta'])
+        start_genome(genome, pool, options)
+    elif job_kind == 'frame':
+        add_frame(genome, result, options, profiler)
+    elif job_kind == 'split':
+        queue_qc_jobs(genome, result, pool)
+    else:
+        genome['qc_results'][job_kind].append(result)
+
+def next_job(genomes: list, start_index: int):
+    # Take the next queued job round-robin across genomes, so every active genome keeps making progress
+    for offset in range(len(genomes)):
+        genome = genomes[(start_index + offset) % len(genomes)]
+        if genome['jobs'] is None:
+            continue
+        try:
+            job = next(genome['jobs'], None)
+        except Exception as error:
+            fail_genome(genome, error)
+            continue
+        if job is None:
+            genome['jobs'] = None
+            continue
+        return (genome, job)
+
+    return (None, None)
+
+def run_batch(genomes: list, options: dict, max_active_genomes: int, profiler: StageProfiler):
+    # Event loop over one worker pool: genomes are scanned, encoded, split and checked concurrently,
+    # with at most max_active_genomes in progress so canvases and reorder buffers stay bounded
+    waiting_genomes = list(genomes)
+    active_genomes = []
+    next_genome = 0
+    with SharedCanvasPool(options['workers']) as pool:
+        while waiting_genomes or active_genomes:
+            # Admit genomes, starting each with a scan of its FASTA
+            while waiting_genomes and len(active_genomes) < max_active_genomes:
+                genome = waiting_genomes.pop(0)
+                genome.update({'stage': 'scan', 'in_flight': 0, 'start_time': time.perf_counter(),
+                               'jobs': iter([('scan', scan_fasta, None, (genome['fasta'], None, False))])})
+                active_genomes.append(genome)
+
+            # Keep the pool full with jobs from every active genome
+            while len(pool.pending) + len(pool.finished) < pool.capacity:
+                genome, job = next_job(active_genomes, next_genome)
+                if genome is None:
+                    break
+                next_genome = (active_genomes.index(genome) + 1) % len(active_genomes)
+                job_kind, function, canvas, args = job
+                pool.submit((genome['name'], job_kind), function, canvas, args)
+                genome['in_flight'] += 1
+
+            # Route the finished jobs, then advance genomes with nothing left queued or running
+            # A failing job or stage fails only its own genome; results still running for it are dropped
+            genomes_by_name = {genome['name']: genome for genome in active_genomes}
+            for (genome_name, job_kind), future in pool.wait_any():
+                genome = genomes_by_name[genome_name]
+                genome['in_flight'] -= 1
+                if genome.get('error') is not None:
+                    continue
+                try:
+                    with profiler.timed(f'batch_{job_kind}_results'):
+                        handle_result(genome, job_kind, future.result(), pool, options, profiler)
+                except Exception as error:
+                    fail_genome(genome, error)
+            for genome in active_genomes:
+                if genome['jobs'] is None and genome['in_flight'] == 0:
+                    try:
+                        advance_genome(genome, pool, options)
+                    except Exception as error:
+                        fail_genome(genome, error)
+                        release_failed_genome(genome, pool)
+            active_genomes = [genome for genome in active_genomes if genome['stage'] != 'done']
+
+def batch_report(genomes: list, wall_seconds: float) -> dict:
+    # Per-genome results and the aggregate nucleotide throughput of the batch
+    genome_reports = []
+    for genome in genomes:
+        fasta_bytes = genome.get('fasta_bytes', 0)
+        genome_reports.append({'name': genome['name'], 'fasta': genome['fasta'], 'image': genome['image'], 'apng': genome.get('apng_file'),
+                               'records': len(genome.get('record_ids', [])), 'frames': genome.get('frame_count'),
+                               'fasta_bytes': fasta_bytes, 'seconds': genome.get('seconds'), 'qc_passed': genome.get('qc_passed', {}),
+                               'error': genome.get('error'),
+                               'passed': genome.get('error') is None and bool(genome.get('qc_passed')) and all(genome['qc_passed'].values())})
+    total_bytes = sum(genome_report['fasta_bytes'] for genome_report in genome_reports)
+
+    return {'genomes': genome_reports,
+            'genome_count': len(genome_reports),
+            'passed_count': sum(genome_report['passed'] for genome_report in genome_reports),
+            'fasta_bytes': total_bytes,
+            'wall_seconds': wall_seconds,
+            'mb_per_second': total_bytes / wall_seconds / 1e6 if wall_seconds else None}
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode many genomes into images in one run, sharing one worker pool.")
+    parser.add_argument("manifest", help="Manifest of FASTA<TAB>image[<TAB>output root] lines")
+    parser.add_argument("--output-root", default='batch_output', help="Output folder for genomes without one in the manifest")
+    parser.add_argument("--max-active-genomes", type=int, default=4, help="Genomes encoded at the same time")
+    parser.add_argument("--report", default=None, help="Write the per-genome results and aggregate throughput to this JSON file")
+    add_pipeline_arguments(parser)
+    args = parser.parse_args()
+    options = get_pipeline_options(args)
+
+    # Stage instrumentation; without a report path every profiler call is a no-op
+    profiler = StageProfiler(enabled=options['profile_report'] is not None)
+
+    genomes = read_batch_manifest(args.manifest, args.output_root)
+    start_time = time.perf_counter()
+    # Missing FASTA files fail their own genome in run_batch, so they are left out of the profiled size
+    batch_bytes = sum(os.path.getsize(genome['fasta']) for genome in genomes if os.path.isfile(genome['fasta'])) if profiler.enabled else 0
+    with profiler.stage('batch', batch_bytes):
+        run_batch(genomes, options, max(args.max_active_genomes, 1), profiler)
+    report = batch_report(genomes, time.perf_counter() - start_time)
+
+    # Aggregate throughput and one line per genome
+    print('\nBATCH SUMMARY')
+    for genome_report in report['genomes']:
+        status = 'PASS' if genome_report['passed'] else 'FAIL'
+        print(f"{status} {genome_report['name']}: {genome_report['records']} records, {genome_report['frames']} frames, {genome_report['seconds']:.2f}s"
+              + (f" ({genome_report['error']})" if genome_report['error'] else ''))
+    print(f"{report['passed_count']}/{report['genome_count']} GENOMES PASSED; {report['fasta_bytes'] / 1e6:.2f} MB in {report['wall_seconds']:.2f}s ({report['mb_per_second']:.2f} MB/s)")
+
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+    profiler.write_report(options['profile_report'], {'manifest': args.manifest, 'workers': options['workers'], 'apng_mode': options['apng_mode'],
+                                                      'max_canvas': options['max_canvas'], 'compression': options['compression'], 'genomes': len(genomes)})
+
+if __name__ == '__main__':
+    main()
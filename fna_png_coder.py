@@ -7,12 +7,10 @@ Created on Sat Apr  1 18:32:39 2023
 ### MAIN FUNCTIONS
 import os
 import sys
+import hashlib
 import argparse
-from PIL import Image
-import pandas as pd
-from Bio import SeqIO
+import numpy as np
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor
 
 # Get Working Directory and 
 working_directory = os.getcwd()
@@ -21,28 +19,157 @@ working_directory = os.getcwd()
 if working_directory not in sys.path:
     sys.path.append(working_directory)
 
-from EncDec.encoding_decoding_funcs import (tetra_bin_encode,
-                                            ascii_bin_encode)
-from NucImg.nucleotide_image_funcs import (get_largest_image_size,
-                                           resize_image,
-                                           process_tetrad_image,
-                                           png_dir_apng_gen,
+from EncDec.encoding_decoding_funcs import (tetra_record_encode,
+                                            tetra_nibble_encode,
+                                            encode_record_sequence,
+                                            nibbles_to_bytes,
+                                            bytes_to_nibbles,
+                                            plan_tile_layout,
+                                            tile_frame_capacity,
+                                            iter_tiled_frames,
+                                            TILE_SEGMENT_TETRADS)
+from NucImg.nucleotide_image_funcs import (get_canvas_size,
+                                           tetrad_count,
+                                           parallel_tetrad_encode,
+                                           in_frame_order,
                                            split_apng,
-                                           get_rgba_values)
-from NucQC.nucleotide_qc_funcs import (md5_checksum,
-                                       first_qc_check,
-                                       second_qc_check,
+                                           get_rgba_array)
+from NucQC.nucleotide_qc_funcs import (parallel_qc_check,
+                                       parallel_tiled_qc_check,
+                                       print_qc_report,
                                        final_qc_check)
-from CustFasta.custom_fasta_funcs import fasta_to_dataframe
+from NucImg.canvas_cache_funcs import (get_base_canvas,
+                                       CANVAS_CACHE_DIRECTORY,
+                                       CANVAS_CACHE_MAX_BYTES)
+from NucImg.png_chunk_funcs import (APNGStreamWriter,
+                                    write_png_file,
+                                    compress_rgba_frame,
+                                    png_compression_settings,
+                                    PNG_COMPRESSION_PRESETS,
+                                    PNG_FILTERS,
+                                    ZLIB_STRATEGIES,
+                                    APNG_DISPOSE_OP_NONE,
+                                    APNG_DISPOSE_OP_PREVIOUS)
+from CustFasta.custom_fasta_funcs import iter_fasta_records, cache_md5_checksum, fasta_line_width
+from Profiling.profiling_funcs import StageProfiler
 
-def find_file_types(directory, file_type):
-    # List all files in the directory
-    all_files = os.listdir(directory)
+def add_pipeline_arguments(parser: argparse.ArgumentParser):
+    # Encoding, compression, cache and profiling options shared by the single-genome and batch entry points
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes for chromosome encoding and QC")
+    parser.add_argument("--apng-mode", choices=['full', 'delta'], default='full', help="Store full-canvas frames, or only each frame's changed region over the base image")
+    parser.add_argument("--max-canvas", type=int, default=None, help="Largest frame side in pixels; records are packed and tiled across frames to fit")
+    parser.add_argument("--png-compression", choices=list(PNG_COMPRESSION_PRESETS), default='default', help="PNG compression preset for the frames and APNG")
+    parser.add_argument("--png-level", type=int, choices=range(0, 10), default=None, help="zlib level, overriding the preset")
+    parser.add_argument("--png-filter", choices=list(PNG_FILTERS), default=None, help="PNG row filter, overriding the preset")
+    parser.add_argument("--png-strategy", choices=list(ZLIB_STRATEGIES), default=None, help="zlib strategy, overriding the preset")
+    parser.add_argument("--png-threads", type=int, default=1, help="Threads compressing blocks of each large frame")
+    parser.add_argument("--canvas-cache", default=CANVAS_CACHE_DIRECTORY, help="Directory caching prepared base canvases between runs")
+    parser.add_argument("--canvas-cache-size", type=int, default=CANVAS_CACHE_MAX_BYTES >> 20, help="Canvas cache size limit in MB; least recently used canvases are evicted")
+    parser.add_argument("--no-canvas-cache", action='store_true', help="Always prepare the base canvas from the image")
+    parser.add_argument("--line-width", type=int, default=None, help="Sequence line width of the reconstructed FASTA; by default the input's, 0 for one line per sequence")
+    parser.add_argument("--profile-report", default=None, help="Write per-stage wall time, CPU time, bytes and peak memory to this JSON file")
+
+def get_pipeline_options(args: argparse.Namespace) -> dict:
+    # Resolve the shared options; frame compression is a preset with any explicit overrides
+    return {'workers': args.workers,
+            'apng_mode': args.apng_mode,
+            'max_canvas': args.max_canvas,
+            'compression': png_compression_settings(args.png_compression, level=args.png_level, filter=args.png_filter,
+                                                    strategy=args.png_strategy, threads=args.png_threads),
+            'canvas_cache': None if args.no_canvas_cache else args.canvas_cache,
+            'canvas_cache_bytes': args.canvas_cache_size * (1 << 20),
+            'line_width': args.line_width,
+            'profile_report': args.profile_report}
+
+def create_genome_directories(genome_directory: str) -> (str, str):
+    # Output and examination folders for one genome
+    output_directory = f'{genome_directory}/output'
+    examination_directory = f'{genome_directory}/examination'
+    for directory in (output_directory, examination_directory):
+        # Check if the directory exists, if not, create it
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+            print(f"Created directory: {directory}")
+        else:
+            print(f"Directory {directory} already exists")
+    
+    return (output_directory, examination_directory)
+
+def keep_scanned_section(encoded_result: tuple) -> tuple:
+    # Compact and run-length sections cost a full encode, so the scan keeps them two nibbles per byte;
+    # table sections are one tetrad per base and are encoded again in one translate pass instead (None)
+    sequence_nibbles, nucleotide_type, encoding_key = encoded_result
+    if encoding_key not in ('compact', 'runlength'):
+        return None
+    
+    return (nibbles_to_bytes(sequence_nibbles), len(sequence_nibbles), nucleotide_type, encoding_key)
+
+def restore_scanned_section(scanned_section: tuple) -> tuple:
+    # Back to the (sequence nibbles, nucleotide type, encoding key) result kept by keep_scanned_section
+    packed_nibbles, nibble_count, nucleotide_type, encoding_key = scanned_section
+    
+    return (bytes_to_nibbles(np.frombuffer(packed_nibbles, dtype=np.uint8))[:nibble_count], nucleotide_type, encoding_key)
+
+def scan_fasta(input_fasta_file: str, profiler: StageProfiler = None, show_progress: bool = True) -> (list, list, str, list):
+    # Stream the FASTA records once to find the tetrad count of each chromosome, hashing the file as it is read
+    # The header holds a fixed-length MD5, so a placeholder gives the same tetrad count as the final checksum
+    # Returns the scanned sections too, so iter_frame_payloads does not encode compact and run-length records again
+    profiler = profiler or StageProfiler()
+    tetrad_counts = []
+    record_ids = []
+    scanned_sections = []
+    fasta_hash = hashlib.md5()
+    placeholder_md5_checksum = '0' * fasta_hash.digest_size * 2
+    fasta_records = profiler.timed_iter('fasta_parse', iter_fasta_records(input_fasta_file, file_hash=fasta_hash), lambda record: len(record[2]))
+    for record_id, description, sequence in tqdm(fasta_records, desc='Processing Sequences', ncols=100, disable=not show_progress):
+        record_ids.append(record_id)
+        with profiler.timed('binary_encode', len(sequence)):
+            encoded_result = encode_record_sequence(description, sequence)
+            tetrad_counts.append(tetrad_count(tetra_record_encode(description, sequence, placeholder_md5_checksum, encoded_result)))
+            scanned_sections.append(keep_scanned_section(encoded_result))
+    
+    return (record_ids, tetrad_counts, fasta_hash.hexdigest(), scanned_sections)
+
+def plan_frames(tetrad_counts: list, max_canvas: int = None) -> (int, int, list, int):
+    # Determine the largest image needed for encoding; returns (width, height, tile layout or None, frame count)
+    max_width, max_height = get_canvas_size(tetrad_counts)
+    if not max_canvas:
+        return (int(max_width), int(max_height), None, len(tetrad_counts))
+    
+    # Tiled layout: bound the canvas and plan which record parts go in each frame
+    max_width = max_height = int(min(max_canvas, get_canvas_size([count + TILE_SEGMENT_TETRADS for count in tetrad_counts])[0] + 1))
+    tile_layout = plan_tile_layout(tetrad_counts, tile_frame_capacity(max_width))
     
-    # Filter the files with 'chrom' in their name and the file_type extension
-    chrom_file_types = [f for f in all_files if f.endswith(file_type)]
+    return (max_width, max_height, tile_layout, len(tile_layout))
+
+def iter_frame_payloads(input_fasta_file: str, md5_checksum: str, tile_layout: list = None, profiler: StageProfiler = None, scanned_sections: list = None):
+    # Stream the records again and encode each chromosome (or tile) payload as it is read
+    # With the scan's sections, compact and run-length records reuse them and the rest only go through their table
+    profiler = profiler or StageProfiler()
+    def encode_records():
+        fasta_records = profiler.timed_iter('fasta_parse', iter_fasta_records(input_fasta_file), lambda record: len(record[2]))
+        for record_index, (record_id, description, sequence) in enumerate(fasta_records):
+            with profiler.timed('binary_encode', len(sequence)):
+                encoded_result = None
+                if scanned_sections is not None:
+                    scanned_section, scanned_sections[record_index] = scanned_sections[record_index], None
+                    encoded_result = restore_scanned_section(scanned_section) if scanned_section is not None else tetra_nibble_encode(sequence, packed_sections=False)
+                frame_payload = tetra_record_encode(description, sequence, md5_checksum, encoded_result)
+            yield frame_payload
+    frame_payloads = encode_records()
+    if tile_layout is not None:
+        frame_payloads = iter_tiled_frames(frame_payloads, tile_layout)
+    
+    return frame_payloads
+
+def frame_index_info(frame_index: int, record_ids: list, tetrad_counts: list, tile_layout: list, md5_checksum: str) -> dict:
+    # APNG frame index metadata: the chromosome in the frame, or the record parts of a tiled frame
+    if tile_layout is not None:
+        return {'segments': [{'id': record_ids[record_index], 'record': record_index, 'offset': part_offset, 'length': part_length, 'tetrads': tetrad_counts[record_index]}
+                             for record_index, part_offset, part_length in tile_layout[frame_index]],
+                'md5': md5_checksum}
     
-    return chrom_file_types
+    return {'id': record_ids[frame_index], 'tetrads': tetrad_counts[frame_index], 'md5': md5_checksum}
 
 def main(working_directory: str):
     """
@@ -50,6 +177,10 @@ def main(working_directory: str):
     """
     # Set/Get Input Files
     working_directory = f'{working_directory}/tests'
+    parser = argparse.ArgumentParser(description="Encode an image with genomic data from a FASTA file.")
+    parser.add_argument("arg1", help="Input FASTA File")
+    parser.add_argument("arg2", help="Input Image File")
+    add_pipeline_arguments(parser)
     if 'SPYDER_ARGS' in os.environ:  # Running in Spyder IDE REPLACE WITH YOUR OWN BEFORE TRYING TO RUN IN IDE        
         # # EXAMPLE DATA 5 Chromosome Organism
         # input_fasta_file = f'{working_directory}/Peltaster_fructicola.fna'
@@ -58,107 +189,109 @@ def main(working_directory: str):
         # EXAMPLE DATA SHORT FNA FILE
         input_fasta_file = f'{working_directory}/small_ex2.fna'
         input_image_file = f'{working_directory}/small_ex.png'
+        args = parser.parse_args([input_fasta_file, input_image_file])
         
     # Running in console
     else:  
-        parser = argparse.ArgumentParser(description="Encode an image with genomic data from a FASTA file.")
-        parser.add_argument("arg1", help="Input FASTA File")
-        parser.add_argument("arg2", help="Input Image File")
-    
         args = parser.parse_args()
-        
         input_fasta_file = args.arg1
         input_image_file = args.arg2
+    
+    options = get_pipeline_options(args)
+    workers = options['workers']
+    apng_mode = options['apng_mode']
+    max_canvas = options['max_canvas']
+    compression = options['compression']
+    profile_report = options['profile_report']
+
+    # Stage instrumentation; without a report path every profiler call is a no-op
+    profiler = StageProfiler(enabled=profile_report is not None)
 
     # Generate Name Prefix
     output_name_prefix = os.path.splitext(os.path.basename(input_image_file))[0]
-    
-    output_directory = f'{working_directory}/{output_name_prefix}/output'
-    examination_directory = f'{working_directory}/{output_name_prefix}/examination'
-    
-    # Check if output_directory exists, if not, create it
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-        print(f"Created directory: {output_directory}")
-    else:
-        print(f"Directory {output_directory} already exists")
-    
-    # Check if examination_directory exists, if not, create it
-    if not os.path.exists(examination_directory):
-        os.makedirs(examination_directory)
-        print(f"Created directory: {examination_directory}")
-    else:
-        print(f"Directory {examination_directory} already exists")
+    output_directory, examination_directory = create_genome_directories(f'{working_directory}/{output_name_prefix}')
     
     output_fasta_file = f'{examination_directory}/{input_fasta_file.split("/")[-1]}'
     original_image_copy = f'{output_directory}/{input_image_file.split("/")[-1]}'
     output_apng_file =  original_image_copy.replace('.png', '.apng')
     
-    # Generate md5 Checksum based on input file
-    generated_md5_checksum = md5_checksum(input_fasta_file)
+    # Stream the FASTA records once to find the tetrad count of each chromosome, hashing the file as it is read
+    with profiler.stage('fasta_scan', os.path.getsize(input_fasta_file)):
+        record_ids, tetrad_counts, generated_md5_checksum, scanned_sections = scan_fasta(input_fasta_file, profiler)
     
-    # Generate Dataframe from the Fasta File
-    fasta_df = fasta_to_dataframe(input_fasta_file)
-    for column in fasta_df.columns:
-        fasta_df[column] = fasta_df[column] #.str.upper() ### POINT OF DEGENERACY ###
+    # Generate md5 Checksum based on input file, cached so later lookups do not read it again
+    cache_md5_checksum(input_fasta_file, generated_md5_checksum)
     
-    # Open the original image and convert it to a palette-based format with 256 colors
-    image = Image.open(input_image_file)
-    palette_image = image.convert("P", palette=Image.ADAPTIVE, colors=256)
+    # Determine the largest image needed for encoding, and the tiled layout when the canvas is bounded
+    max_width, max_height, tile_layout, frame_count = plan_frames(tetrad_counts, max_canvas)
+    frame_name = 'tile' if tile_layout is not None else 'chrom'
+    encoded_image_list = [f'{output_directory}/{output_name_prefix}_{frame_name}_{idx + 1}.png' for idx in range(frame_count)]
     
-    # Save the palette image to the output directory
-    palette_image.save(original_image_copy)
+    # Quantize the original image to 256 colors and center it on the largest image size, reusing a cached canvas when the artwork and size match
+    # The prepared canvas is saved to the output directory as the base image copy
+    with profiler.stage('resize', max_width * max_height * 4):
+        base_rgba, canvas_cache_hit = get_base_canvas(input_image_file, max_width, max_height, options['canvas_cache'], options['canvas_cache_bytes'])
+        write_png_file(original_image_copy, max_width, max_height, compress_rgba_frame(base_rgba, compression))
+    print(f'Base canvas {max_width}x{max_height} {"loaded from cache" if canvas_cache_hit else "prepared"}')
     
-    # Determine the largest image size needed to fit the largest chromosome data
-    binary_data_list = []
-    for idx, row in tqdm(fasta_df.iterrows(), total=fasta_df.shape[0], desc='Processing Sequences', ncols=100):
-        description = row['Description']
-        sequence = row['Sequence']
-        sequence_binary, nucleotide_type, encoding_key = tetra_bin_encode(sequence)
-        md5_desc_type_enc = f'{description}<{generated_md5_checksum}<{nucleotide_type}<{encoding_key}<'
-        md5_desc_type_enc_binary = ascii_bin_encode(md5_desc_type_enc)
-        data_binary = md5_desc_type_enc_binary + sequence_binary
-        binary_data_list.append(data_binary)
+    # Stream the records again, handing each encoded chromosome (or tile) to the worker pool as it is read
+    delta_frames = apng_mode == 'delta'
+    frame_payloads = iter_frame_payloads(input_fasta_file, generated_md5_checksum, tile_layout, profiler, scanned_sections)
+    frame_jobs = ((idx, frame_payload, encoded_image_list[idx], delta_frames, compression) for idx, frame_payload in enumerate(frame_payloads))
+    frame_timings = []
     
-    # Determine the largest image needed for encoding
-    max_width, max_height = get_largest_image_size(binary_data_list)
+    # Write the APNG as the frames arrive: the base image first, then each frame in order
+    # Delta frames cover only their changed region and are disposed back to the base image afterwards
+    dispose_op = APNG_DISPOSE_OP_PREVIOUS if delta_frames else APNG_DISPOSE_OP_NONE
+    with profiler.stage('frame_pipeline') as pipeline_stage, APNGStreamWriter(output_apng_file, max_width, max_height) as apng_writer:
+        with profiler.timed('apng_build', base_rgba.nbytes):
+            apng_writer.append_rgba(base_rgba, compression)
+        encoded_frames = parallel_tetrad_encode(base_rgba, frame_jobs, workers)
+        for idx, output_filename, compressed_frame, frame_box, frame_seconds in tqdm(in_frame_order(encoded_frames), total=frame_count, desc="Encoding chromosomes", ncols=100):
+            frame_info = frame_index_info(idx, record_ids, tetrad_counts, tile_layout, generated_md5_checksum)
+            with profiler.timed('apng_build', len(compressed_frame)):
+                apng_writer.append(compressed_frame, frame_box, dispose_op=dispose_op, frame_info=frame_info)
+            frame_timings.append((output_filename, frame_seconds))
+            
+            # Frames are embedded, compressed and saved in the workers, so their time is the summed worker time
+            profiler.add('frame_embed', frame_seconds, frame_box[2] * frame_box[3] * 4)
+            pipeline_stage['bytes'] += len(compressed_frame)
     
-    # Resize the original image copy to the largest image size
-    img_resized = resize_image(original_image_copy, max_width, max_height)
-    img_resized.save(original_image_copy)
-    
-    # Encode all subsequent chromosome data using the resized image
-    for idx, data_binary in tqdm(enumerate(binary_data_list), total=len(binary_data_list), desc="Encoding chromosomes", ncols=100):
-        output_filename = f'{output_directory}/{output_name_prefix}_chrom_{idx + 1}.png'
-        process_tetrad_image(original_image_copy, data_binary, output_filename)
-    
-    # Generate the APNG
-    png_dir_apng_gen(output_directory, output_apng_file)
+    # Report the time spent on each frame
+    for output_filename, frame_seconds in frame_timings:
+        print(f'{output_filename} encoded in {frame_seconds:.2f}s')
 
     # QUALITY CONTROL CHECKS
-    split_apng(output_apng_file, examination_directory)
+    with profiler.stage('split_apng', os.path.getsize(output_apng_file)):
+        apng_image_list = split_apng(output_apng_file, examination_directory, compression)
+
+    # Tiled frames are reassembled into records before checking; otherwise frame i holds record i
+    qc_check = parallel_tiled_qc_check if tile_layout is not None else parallel_qc_check
 
-    # FIRST QC Check
+    # FIRST QC Check: every output frame against its source record
     print('\nSTARTING FIRST QC CHECK: IMAGE ENCODING/DECODING')
-    encoded_image_list = find_file_types(output_directory, '.png')
-    encoded_image_list = [f'{output_directory}/{image_path}' for image_path in encoded_image_list]
-    
-    with ThreadPoolExecutor() as executor:
-        # Use executor.map() to call first_qc_check with these arguments
-        executor.map(first_qc_check, [input_fasta_file]*len(encoded_image_list), range(len(encoded_image_list)), encoded_image_list)
+    original_rgba_values = base_rgba
+    with profiler.stage('first_qc', sum(os.path.getsize(image_path) for image_path in encoded_image_list)):
+        first_qc_results = qc_check(original_rgba_values, encoded_image_list, iter_fasta_records(input_fasta_file), generated_md5_checksum, workers)
+    print_qc_report('FIRST QC', [report for report, _ in first_qc_results])
 
-    # SECOND QC Check
+    # SECOND QC Check: the APNG frames (the first frame is the base image) against their source records
     print('\nSTARTING SECOND QC CHECK: ANIMATED PNG ENCODING/DECODING')
-    apng_image_list = find_file_types(examination_directory, '.png')
-    apng_image_list = [f'{examination_directory}/{image_path}' for image_path in apng_image_list]
-    original_rgba_values, width = get_rgba_values(apng_image_list[0])
-    
-    with ThreadPoolExecutor() as executor:
-        extracted_results = list(executor.map(second_qc_check, range(len(encoded_image_list)), encoded_image_list, [apng_image_list] * len(encoded_image_list), [original_rgba_values] * len(encoded_image_list), [input_fasta_file] * len(encoded_image_list)))
+    original_rgba_values, width = get_rgba_array(apng_image_list[0])
+    with profiler.stage('second_qc', sum(os.path.getsize(image_path) for image_path in apng_image_list[1:])):
+        second_qc_results = qc_check(original_rgba_values, apng_image_list[1:], iter_fasta_records(input_fasta_file), generated_md5_checksum, workers)
+    print_qc_report('SECOND QC', [report for report, _ in second_qc_results])
     
-    # FINAL QC Check
+    # FINAL QC Check: stream the passing records into a FASTA wrapped like the input
     print('\nSTARTING FINAL QC CHECK: FNA DECODING')
-    final_qc_check(extracted_results, output_fasta_file)
+    line_width = options['line_width'] if options['line_width'] is not None else fasta_line_width(input_fasta_file)
+    extracted_results = (record for report, record in second_qc_results if report['passed'])
+    with profiler.stage('final_qc', os.path.getsize(input_fasta_file)):
+        final_qc_check(extracted_results, output_fasta_file, generated_md5_checksum, line_width)
+    
+    # Write the stage profile
+    profiler.write_report(profile_report, {'input_fasta_file': input_fasta_file, 'input_image_file': input_image_file, 'workers': workers,
+                                           'apng_mode': apng_mode, 'max_canvas': max_canvas, 'compression': compression, 'frames': frame_count, 'canvas': [max_width, max_height]})
 
 if __name__ == '__main__':
     main(working_directory)
\ No newline at end of file